@@ -3,6 +3,10 @@
 # Very basic just to see if things work
 
 import sys
+import os
+import json
+import socket
+import time
 import upnpclient
 import xml.etree.ElementTree as ET
 
@@ -11,20 +15,202 @@ from urllib.parse import urlparse
 
 # Launching clients
 import subprocess
+import threading
+import asyncio
+import RTPClient
 
 DEBUG = True
 
 
-timeout = 5
-print('Searching devices for {} seconds...'.format(timeout))
-devices = upnpclient.discover(timeout)
-print('Search done')
+class SessionManager:
+	"""Runs all the RTP streams in this process and keeps track of the VNC viewers
+
+	The RTP sessions run as tasks on one asyncio event loop in a background
+	thread, so they share one interpreter and GStreamer context.
+	"""
+
+	def __init__(self):
+		self.rtpInProcess = RTPClient.gstAvailable()
+		self.loop = None
+		if self.rtpInProcess:
+			self.loop = asyncio.new_event_loop()
+			self.thread = threading.Thread(target=self.loop.run_forever)
+			self.thread.daemon = True
+			self.thread.start()
+
+		self.rtp = {}	# URI -> Future of RTPSession.run or Popen of RTPClient.py
+		self.vnc = {}	# URI -> Popen of the viewer
+
+	def rtpRunning(self, uri):
+		if not uri in self.rtp:
+			return False
+		if self.rtpInProcess:
+			return not self.rtp[uri].done()
+		return self.rtp[uri].poll() is None
+
+	# launched is the time.monotonic() of the LaunchApplication response, for the startup time
+	def startRTP(self, uri, stream_format=None, launched=None):
+		if self.rtpRunning(uri):
+			return
+
+		uri_part = urlparse(uri)
+		stream_type = 0	# Autodetect
+		if stream_format:
+			stream_type = int(stream_format.split(',')[0])	# Format is a list of payloads
+
+		if self.rtpInProcess:
+			print('Starting RTP stream from {}'.format(uri))
+			session = RTPClient.RTPSession(uri_part.hostname, uri_part.port, stream_type=stream_type, verbose=DEBUG, launched=launched)
+			self.rtp[uri] = asyncio.run_coroutine_threadsafe(session.run(), self.loop)
+		else:
+			cmd = ['python3', 'RTPClient.py', '{}'.format(uri_part.hostname), '{}'.format(uri_part.port)]
+			if stream_type:
+				cmd.extend(['-t', '{}'.format(stream_type)])
+			print('Launching: {}'.format(' '.join(x for x in cmd)))
+			self.rtp[uri] = subprocess.Popen(cmd)
+
+	def startVNC(self, uri):
+		if (uri in self.vnc) and (self.vnc[uri].poll() is None):
+			# TODO: Bring the client forwards when the viewer already exists
+			return
+
+		# New URI or the existing client has terminated
+		uri_part = urlparse(uri)
+		#cmd =['vncviewer', '--Log=*:stderr:100', '{}::{}'.format(uri_part.hostname, uri_part.port)]
+		cmd =['python', 'vncviewer/vncviewer_ml.py', '--host={}'.format(uri_part.hostname), '--display={}'.format(uri_part.port-5900)]
+		print('Launching: {}'.format(' '.join(x for x in cmd)))
+		self.vnc[uri] = subprocess.Popen(cmd)
+
+	def stopAll(self):
+		for uri in self.vnc:
+			self.vnc[uri].terminate()
+
+		if not self.loop:
+			for uri in self.rtp:
+				self.rtp[uri].terminate()
+			return
+
+		# Stop the loop first, then run the cancelled tasks to the end in this
+		# thread, so that their finally blocks set the pipelines to NULL
+		self.loop.call_soon_threadsafe(self.loop.stop)
+		self.thread.join()
+
+		tasks = asyncio.all_tasks(self.loop)
+		for task in tasks:
+			task.cancel()
+		self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+		self.loop.close()
+
+
+# Device discovery
+SERVER_TYPE = 'urn:schemas-upnp-org:device:TmServerDevice:1'
+SSDP_ADDR = ('239.255.255.250', 1900)
+
+cache_file = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'tmlink', 'devices.json')
+
+def loadDeviceCache():
+	"""Return the cached servers as dict of UDN -> location"""
+	try:
+		with open(cache_file) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return {}
+
+def saveDeviceCache(devices):
+	try:
+		os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+		with open(cache_file, 'w') as f:
+			json.dump({device.udn: device.location for device in devices}, f)
+	except OSError as e:
+		print('Could not save device cache: {}'.format(e))
+
+def openDevice(location, udn=None):
+	"""Fetch the description directly, returns None if it is not the expected server"""
+	# Stale address of an unplugged gadget would wait for the whole HTTP timeout
+	part = urlparse(location)
+	try:
+		socket.create_connection((part.hostname, part.port or 80), timeout=0.5).close()
+	except (OSError, ValueError):
+		return None
+
+	try:
+		device = upnpclient.Device(location)
+	except Exception as e:
+		if DEBUG:
+			print('No server at {}: {}'.format(location, e))
+		return None
+
+	if device.device_type != SERVER_TYPE or (udn and device.udn != udn):
+		return None
+	return device
+
+def searchServer(timeout=5, mx=1):
+	"""M-SEARCH for the server and return the location of the first one that answers"""
+	request = '\r\n'.join([
+		'M-SEARCH * HTTP/1.1',
+		'HOST: {}:{}'.format(*SSDP_ADDR),
+		'MAN: "ssdp:discover"',
+		'MX: {}'.format(mx),
+		'ST: {}'.format(SERVER_TYPE),
+		'', '']).encode()
+
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+	sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+	try:
+		deadline = time.monotonic() + timeout
+		resend = 0
+		while True:
+			now = time.monotonic()
+			if now >= deadline:
+				return None
+			if now >= resend:	# UDP may be lost, repeat the search every MX seconds
+				sock.sendto(request, SSDP_ADDR)
+				resend = now + mx
+
+			sock.settimeout(min(deadline, resend) - now)
+			try:
+				data, addr = sock.recvfrom(4096)
+			except socket.timeout:
+				continue
+
+			headers = {}
+			for line in data.decode(errors='replace').split('\r\n')[1:]:
+				key, sep, value = line.partition(':')
+				if sep:
+					headers[key.strip().upper()] = value.strip()
+
+			if headers.get('ST') == SERVER_TYPE and 'LOCATION' in headers:
+				return headers['LOCATION']
+	finally:
+		sock.close()
+
 
 tmlinkServer = []
-for device in devices:
-	if device.device_type == 'urn:schemas-upnp-org:device:TmServerDevice:1':
+started = time.monotonic()
+
+# Try the servers found last time first, the gadget is most likely the same
+for udn, location in loadDeviceCache().items():
+	device = openDevice(location, udn)
+	if device:
 		tmlinkServer.append(device)
-		print('Found server at {}'.format(device.location))
+		print('Found cached server at {}'.format(device.location))
+
+if len(tmlinkServer) == 0:
+	timeout = 5
+	print('Searching devices for at most {} seconds...'.format(timeout))
+	location = searchServer(timeout)
+	if location:
+		device = openDevice(location)
+		if device:
+			tmlinkServer.append(device)
+			print('Found server at {}'.format(device.location))
+	print('Search done')
+
+if DEBUG:
+	print('Discovery took {:.3f} s'.format(time.monotonic() - started))
+
+if len(tmlinkServer) > 0:
+	saveDeviceCache(tmlinkServer)
 
 
 print()
@@ -110,8 +296,7 @@ for app in apps:
 	applications.append(newApp)
 
 
-vnc_clients = {}
-rtp_clients = {}
+sessions = SessionManager()
 
 while True:
 	# Print applications and select action
@@ -143,29 +328,16 @@ while True:
 	if action == 0:
 		# Launch application
 		ret = server.service_map[server_name].LaunchApplication(AppID='{}'.format(applications[ID]['id']), ProfileID=0)
+		launched = time.monotonic()
 		uri = ret['AppURI']
 		uri_part = urlparse(uri)
 
 		# Check the protocol
 		if uri_part.scheme.lower() == 'vnc':
-			if (not uri in vnc_clients) or (vnc_clients[uri].poll() is not None):
-				# TODO: Bring the client forwards when the viewer already exists
-				# New URI or the existing client has terminated
-				#cmd =['vncviewer', '--Log=*:stderr:100', '{}::{}'.format(uri_part.hostname, uri_part.port)]
-				cmd =['python', 'vncviewer/vncviewer_ml.py', '--host={}'.format(uri_part.hostname), '--display={}'.format(uri_part.port-5900)]
-				print('Launching: {}'.format(' '.join(x for x in cmd)))
-				proc = subprocess.Popen(cmd)
-				vnc_clients[uri] = proc
+			sessions.startVNC(uri)
 
 		elif uri_part.scheme.lower() == 'rtp':
-			if (not uri in rtp_clients) or rtp_clients[uri].poll() is None:
-				# New URI or the existing client has terminated
-				cmd = ['python3', 'RTPClient.py', '{}'.format(uri_part.hostname), '{}'.format(uri_part.port)]
-				if 'format' in applications[ID]:
-					cmd.append('-t {}'.format(applications[ID]['format']))
-				print('Launching: {}'.format(' '.join(x for x in cmd)))
-				proc = subprocess.Popen(cmd)
-				rtp_clients[uri] = proc
+			sessions.startRTP(uri, applications[ID].get('format'), launched)
 
 		else:
 			print('Unknown protocol in URI: {}'.format(uri))
@@ -183,10 +355,4 @@ while True:
 
 	print
 
-for uri in vnc_clients:
-	vnc_clients[uri].terminate()
-	#vnc_clients[uri].kill()
-
-for uri in rtp_clients:
-	rtp_clients[uri].terminate()
-	#rtp_clients[uri].kill()
+sessions.stopAll()
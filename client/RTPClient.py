@@ -4,100 +4,127 @@
 # Copyright (C) 2019 Lauri Peltonen
 
 import argparse
+import asyncio
 
 import socket
 import select
 import time
+import struct
 
 import subprocess
+import os
+import collections
 
-# Send a single byte start packet to the host
-def sendStartPacket(host, port, interface=None, local_port=0):
+# Open the UDP socket used for the whole session (start packets, detection and playback)
+# Returns the socket or None on error
+def openSocket(host, port, interface=None, local_port=0):
 	if not interface:
 		interface = '0.0.0.0'
 
 	if not local_port:
 		local_port = 0
 
-	# Do an UDP "connect" to resolve the interface (and random port)
+	# Do an UDP "connect" to resolve the interface
+	# The session socket itself is left unconnected, as the stream may come from another port
 	try:
+		probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		probe.bind((interface, 0))
+		probe.connect((host, port))
+		interface = probe.getsockname()[0]
+		probe.close()
+
 		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 		sock.bind((interface, local_port))
-		sock.connect((host, port))
 	except:
 		print('Could not open socket or remote host unreachable on given (or any) interface')
-		sock.close()
-		return (None, None)
+		return None
+
+	print(sock.getsockname())
+	return sock
 
-	interface = sock.getsockname()[0]
-	port = sock.getsockname()[1]
-	print(interface, port)
 
-	# Send single null byte (byte value is not specified)
-	sock.send(b'\00')
+# Send a single byte start (or keep-alive) packet to the host
+def sendKeepAlive(sock, host, port):
+	# Byte value is not specified
+	sock.sendto(b'\00', (host, port))
+
+
+# Send start packets to the host until something is received
+# The received data is left in the socket for the payload detection
+def sendStartPacket(sock, host, port):
+	sendKeepAlive(sock, host, port)
 
 	# Wait until we receive something
 	# According to spec, the 1 byte package must be sent until
 	# a single RTP packet is received
 	while not any(select.select([sock], [], [], 1)):	# 1 sec timeout
-		# Send single null byte (byte value is not specified)
-		sock.send(b'\00')
-
-	sock.close()
+		sendKeepAlive(sock, host, port)
 
-	return (interface, port)
 
-
-# Try to detect RTP payload type, return payload (int) or None on error
-def detectPayloadType(interface, port, timeout=5, packets=0):
-	# Create UDP socket
-	try:
-		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-		sock.bind((interface, port))
-		sock.settimeout(timeout)
-	except:
-		# TODO: Better error handler if port/interface error?
-		print('Error opening socket')
+# Parse RTP header, return (payload, sequence number, SSRC) or None if not a RTP packet
+def parseRTPHeader(data):
+	if len(data) < 12 or data[0] >> 6 != 2:	# RTP version 2
 		return None
 
-	payload = None
-	selectedPayload = None
-
-	timeout += time.time()
+	payload = data[1] & 0x7F
+	seq, ssrc = struct.unpack('!H4xI', data[2:12])
+	return (payload, seq, ssrc)
+
+
+# RTP payload type detector
+# The payload type is accepted after given number of consecutive packets of the
+# same source (SSRC) and payload type, with the sequence number continuing
+class PayloadDetector:
+	def __init__(self, packets=3):
+		self.packets = packets
+		self.received = []	# Packets of the candidate stream
+		self.candidate = None	# (payload, sequence number, SSRC) of the last valid packet
+		self.votes = 0
+
+	# Add received packet, return True when the payload type is decided
+	def feed(self, data):
+		header = parseRTPHeader(data)
+		if not header:
+			return False	# Not RTP, e.g. noise
+
+		# Same source and payload, and sequence continues (allowing few lost packets)
+		candidate = self.candidate
+		if candidate and header[0] == candidate[0] and header[2] == candidate[2] and \
+				0 < ((header[1] - candidate[1]) & 0xFFFF) < 16:
+			self.votes += 1
+		else:
+			self.votes = 1
+			self.received = []
+
+		self.candidate = header
+		self.received.append(data)
+		return self.votes >= self.packets
+
+	# Return (payload (int) or None, list of the received packets of the stream)
+	def result(self):
+		if not self.candidate:
+			return (None, [])
+		return (self.candidate[0], self.received)
+
+
+# Try to detect RTP payload type
+# The payload type is decided after given number of packets (see PayloadDetector),
+# or with the last valid packet when the timeout (s) expires.
+# Returns (payload (int) or None on error, list of the received packets of the stream)
+def detectPayloadType(sock, timeout=5, packets=3):
+	detector = PayloadDetector(packets)
+
+	deadline = time.time() + timeout
 	while True:
-		recv = select.select([sock], [], [], 1)	# 1 sec timeout
-		if any(recv):
-			try:
-				data, address = sock.recvfrom(1024)	# TODO: How many bytes??
-			except socket.timeout:
-				print('Receive timeout')
-				return None
+		remaining = deadline - time.time()
+		if remaining <= 0 or not select.select([sock], [], [], remaining)[0]:
+			break
 
-			# Figure out the RTP stream type
-			# The payload (stream type) is the low 7 bits of 2nd byte
-			oldPayload = payload
-			#payload = ord(data[1]) & 0x7F
-			payload = data[1] & 0x7F
+		data, address = sock.recvfrom(2048)
+		if detector.feed(data):
+			break
 
-			if payload != oldPayload:
-				votes = 1	# Require X times the same value to be sure
-			else:
-				votes += 1
-
-			if votes > packets:
-				selectedPayload = payload
-			#selectedPayload = payload
-
-			if selectedPayload is not None:
-				break
-
-			if time.time() > timeout:
-				break
-
-	if sock:
-		sock.close()
-
-	return selectedPayload
+	return detector.result()
 
 
 
@@ -113,30 +140,136 @@ stream_types = {
 }
 
 
+# Jitter buffer modes, see rtpjitterbuffer documentation
+jitter_modes = ['none', 'slave', 'buffer', 'synced']
+
+
+# Counter of the RTP packets arriving after a packet with a higher sequence number
+# rtpjitterbuffer puts them back in order but does not count them. Duplicates
+# (within the last window packets) are not counted, the jitter buffer does that.
+class ReorderCounter:
+	def __init__(self, window=128):
+		self.highest = None	# Highest sequence number so far
+		self.recent = collections.deque(maxlen=window)
+		self.reordered = 0
+
+	def feed(self, data):
+		header = parseRTPHeader(data)
+		if not header:
+			return
+		seq = header[1]
+		if seq in self.recent:
+			return	# Duplicate
+		self.recent.append(seq)
+
+		# Ahead of the highest one, allowing the sequence number to wrap
+		if self.highest is None or 0 < ((seq - self.highest) & 0xFFFF) < 0x8000:
+			self.highest = seq
+		else:
+			self.reordered += 1
+
+
+# Print the jitter buffer statistics
+def printJitterStats(jitter, reorder=None):
+	stats = jitter.get_property('stats')
+	print('Jitter buffer: pushed {}, lost {}, late {}, duplicates {}, reordered {}, jitter {} ns, fill {} %'.format(
+		stats.get_value('num-pushed'), stats.get_value('num-lost'), stats.get_value('num-late'),
+		stats.get_value('num-duplicates'), reorder.reordered if reorder else 'n/a',
+		stats.get_value('avg-jitter'), jitter.get_property('percent')))
+
+
+# Build the GStreamer playback pipeline reading the stream from sock
+# first_sample is called from the streaming thread when the first audio buffer goes to the sink
+# reorder (ReorderCounter) is fed the packets as they arrive to the jitter buffer
+# Raises an exception if GStreamer bindings are not available
+def buildPipeline(sock, stream_type, jitter, early_packets=None, first_sample=None, reorder=None):
+	import gi
+	gi.require_version('Gst', '1.0')
+	from gi.repository import Gst, Gio
+
+	Gst.init(None)
+
+	# Create the pipeline
+	pipeline_str = 'udpsrc name=src close-socket=false caps=\"{}\" ! {} ! rtpL16depay name=depay ! playsink'.format(stream_types[stream_type], jitter)
+	if early_packets:
+		# Already received packets are played first, funnel continues with udpsrc after them
+		pipeline_str = 'appsrc name=early is-live=true do-timestamp=true format=time caps=\"{0}\" ! funnel name=in ! {1} ! rtpL16depay name=depay ! playsink ' \
+			'udpsrc name=src close-socket=false caps=\"{0}\" ! in.'.format(stream_types[stream_type], jitter)
+	pipeline = Gst.parse_launch(pipeline_str)
+
+	# udpsrc reads the same socket, so nothing is lost between detection and playback
+	gsocket = Gio.Socket.new_from_fd(os.dup(sock.fileno()))
+	pipeline.get_by_name('src').set_property('socket', gsocket)
+
+	if first_sample:
+		# Depayloaded buffers are pushed to the sink, the probe is removed after the first one
+		def probe(pad, info):
+			first_sample()
+			return Gst.PadProbeReturn.REMOVE
+		pipeline.get_by_name('depay').get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, probe)
+
+	if reorder is not None:
+		# Packets in arrival order, before the jitter buffer sorts them
+		def count(pad, info):
+			buf = info.get_buffer()
+			reorder.feed(buf.extract_dup(0, min(buf.get_size(), 12)))
+			return Gst.PadProbeReturn.OK
+		pipeline.get_by_name('jitter').get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, count)
+
+	pipeline.set_state(Gst.State.PLAYING)
+
+	if early_packets:
+		early = pipeline.get_by_name('early')
+		for data in early_packets:
+			early.emit('push-buffer', Gst.Buffer.new_wrapped(data))
+		early.emit('end-of-stream')
+
+	return pipeline
+
+
+# Jitter buffer element description
+def jitterBuffer(latency, jitter_mode, drop_late):
+	return 'rtpjitterbuffer name=jitter latency={} mode={} drop-on-latency={}'.format(
+		latency, jitter_mode, 'true' if drop_late else 'false')
+
+
 # Launch the RTP client. Blocks on success, returns client return code or None on error
-def launchRTPClient(interface, port, stream_type, verbose = False, quiet = True):
+# latency is the jitter buffer length in ms, drop_late drops packets that arrive
+# too late to be played in time, stats_interval is in seconds (0 = no statistics)
+# early_packets are the packets already received e.g. during payload detection
+# The stream is received from sock, and keep-alive packets are sent from it to
+# host:port every keepalive seconds (0 = never)
+def launchRTPClient(sock, host, port, stream_type, verbose = False, quiet = True,
+		latency = 200, jitter_mode = 'slave', drop_late = False, stats_interval = 10, early_packets = None,
+		keepalive = 5):
 	if not stream_type in stream_types:
 		print('Unknown payload type: {}'.format(stream_type))
 		return None
 
+	jitter = jitterBuffer(latency, jitter_mode, drop_late)
+
 	# Try to build the pipeline via GStreamer bindings
 	try:
-		import gi
-		gi.require_version('Gst', '1.0')
-		from gi.repository import Gst, GObject
-
-		Gst.init(None)
-
-		# Create the pipeline
-		pipeline_str = 'udpsrc port={} caps=\"{}\" ! rtpL16depay ! playsink'.format(port, stream_types[stream_type])
-		pipeline = Gst.parse_launch(pipeline_str)
-		pipeline.set_state(Gst.State.PLAYING)
+		reorder = ReorderCounter()
+		pipeline = buildPipeline(sock, stream_type, jitter, early_packets, reorder=reorder)
+		from gi.repository import Gst
 
 		# Listen for messages
 		bus = pipeline.get_bus()
 		terminate = False
+		next_stats = time.time() + stats_interval
+		next_keepalive = time.time() + keepalive
 		while not terminate:
 			msg = bus.timed_pop_filtered(Gst.SECOND, Gst.MessageType.ERROR | Gst.MessageType.EOS)
+
+			if stats_interval and time.time() >= next_stats:
+				printJitterStats(pipeline.get_by_name('jitter'), reorder)
+				next_stats += stats_interval
+
+			if keepalive and time.time() >= next_keepalive:
+				sendKeepAlive(sock, host, port)
+				next_keepalive += keepalive
+
 			if not msg:
 				continue
 			# Only error or end-of-stream messages should get this far -> they terminate
@@ -158,12 +291,195 @@ def launchRTPClient(interface, port, stream_type, verbose = False, quiet = True)
 		if quiet:
 			print('Quiet mode')
 			cmd.extend(['-q', '--no-position'])
-		cmd.extend(['udpsrc', 'port={}'.format(port), 'caps=\"{}\"'.format(stream_types[stream_type]), '!', 'rtpL16depay', '!', 'playsink'])
+		# gst-launch needs to bind the port itself
+		local_port = sock.getsockname()[1]
+		sock.close()
+		cmd.extend(['udpsrc', 'port={}'.format(local_port), 'caps=\"{}\"'.format(stream_types[stream_type]), '!'])
+		cmd.extend(jitter.split())
+		cmd.extend(['!', 'rtpL16depay', '!', 'playsink'])
 
 		print(' '.join(x for x in cmd))
 		return subprocess.call(cmd)
 
 
+# Check if GStreamer python bindings are available
+def gstAvailable():
+	try:
+		import gi
+		gi.require_version('Gst', '1.0')
+		from gi.repository import Gst
+	except (ImportError, ValueError):
+		return False
+	return True
+
+
+# Asynchronous RTP client session
+# Handshake, payload detection, pipeline bus monitoring, keep-alives and statistics
+# run as cooperating tasks on the asyncio event loop, so that one process can
+# handle several streams at once, e.g. asyncio.gather(session1.run(), session2.run())
+class RTPSession:
+	def __init__(self, host, port, interface=None, local_port=0, stream_type=0,
+			detect_timeout=5, detect_packets=3, latency=200, jitter_mode='slave',
+			drop_late=False, stats_interval=10, keepalive=5, verbose=False, launched=None):
+		self.host = host
+		self.port = port
+		self.interface = interface
+		self.local_port = local_port
+		self.stream_type = stream_type
+
+		self.detect_timeout = detect_timeout
+		self.detect_packets = detect_packets
+		self.jitter = jitterBuffer(latency, jitter_mode, drop_late)
+		self.stats_interval = stats_interval
+		self.keepalive = keepalive
+		self.verbose = verbose
+		self.launched = launched	# time.monotonic() of the LaunchApplication response, if known
+
+		self.sock = None
+		self.pipeline = None
+		self.reorder = ReorderCounter()
+
+	# Send start packets with increasing interval until the first packet arrives
+	async def handshake(self, interval=0.1, max_interval=2):
+		loop = asyncio.get_running_loop()
+		readable = loop.create_future()
+		loop.add_reader(self.sock.fileno(), lambda: readable.done() or readable.set_result(True))
+		try:
+			while True:
+				sendKeepAlive(self.sock, self.host, self.port)
+				try:
+					await asyncio.wait_for(asyncio.shield(readable), interval)
+					return
+				except asyncio.TimeoutError:
+					interval = min(interval * 2, max_interval)
+		finally:
+			loop.remove_reader(self.sock.fileno())
+
+	# Detect the payload type, see detectPayloadType
+	async def detect(self):
+		loop = asyncio.get_running_loop()
+		detector = PayloadDetector(self.detect_packets)
+
+		deadline = loop.time() + self.detect_timeout
+		while True:
+			remaining = deadline - loop.time()
+			if remaining <= 0:
+				break
+			try:
+				data = await asyncio.wait_for(loop.sock_recv(self.sock, 2048), remaining)
+			except asyncio.TimeoutError:
+				break
+			if detector.feed(data):
+				break
+
+		return detector.result()
+
+	# Wait until the pipeline reports error or end of stream
+	async def monitorBus(self):
+		from gi.repository import Gst
+
+		loop = asyncio.get_running_loop()
+		bus = self.pipeline.get_bus()
+		done = loop.create_future()
+
+		# Bus file descriptor is readable while there are messages
+		def readMessages():
+			msg = bus.pop_filtered(Gst.MessageType.ERROR | Gst.MessageType.EOS)
+			while msg:
+				if not done.done():
+					done.set_result(msg)
+				msg = bus.pop_filtered(Gst.MessageType.ERROR | Gst.MessageType.EOS)
+
+		fd = bus.get_pollfd().fd
+		loop.add_reader(fd, readMessages)
+		try:
+			msg = await done
+		finally:
+			loop.remove_reader(fd)
+
+		if msg.type == Gst.MessageType.ERROR:
+			err, debug = msg.parse_error()
+			print('Stream error: {}'.format(err))
+			return -1
+		return 0
+
+	# Return the callback printing when the first sample reaches the sink,
+	# measured from the LaunchApplication response or else from started (time.monotonic())
+	def firstSample(self, started):
+		reference = self.launched if self.launched is not None else started
+		source = 'the LaunchApplication response' if self.launched is not None else 'session start'
+
+		def reached():
+			print('First audio sample to the sink {:.3f} s after {}'.format(time.monotonic() - reference, source))
+		return reached
+
+	async def sendKeepAlives(self):
+		while True:
+			await asyncio.sleep(self.keepalive)
+			sendKeepAlive(self.sock, self.host, self.port)
+
+	async def printStats(self):
+		while True:
+			await asyncio.sleep(self.stats_interval)
+			printJitterStats(self.pipeline.get_by_name('jitter'), self.reorder)
+
+	# Run the whole session, returns pipeline return code or None on error
+	async def run(self):
+		self.sock = openSocket(self.host, self.port, self.interface, self.local_port)
+		if not self.sock:
+			return None
+		self.sock.setblocking(False)
+
+		loop = asyncio.get_running_loop()
+		started = loop.time()
+		session_started = time.monotonic()	# Same clock as self.launched
+		if self.verbose and self.launched is not None:
+			print('Session started {:.3f} s after the LaunchApplication response'.format(time.monotonic() - self.launched))
+		try:
+			await self.handshake()
+			if self.verbose:
+				print('First packet after {:.3f} s'.format(loop.time() - started))
+
+			stream_type = self.stream_type
+			early_packets = None
+			if not stream_type:
+				(stream_type, early_packets) = await self.detect()
+				if self.verbose:
+					print('Stream type detected after {:.3f} s from {} packets'.format(loop.time() - started, len(early_packets)))
+
+			if not stream_type:
+				print('Stream type was not detected, timeout')
+				return None
+			if not stream_type in stream_types:
+				print('Unknown payload type: {}'.format(stream_type))
+				return None
+
+			print('Payload type: {}'.format(stream_type))
+			first_sample = self.firstSample(session_started) if self.verbose else None
+			self.pipeline = buildPipeline(self.sock, stream_type, self.jitter, early_packets, first_sample, self.reorder)
+
+			tasks = []
+			if self.keepalive:
+				tasks.append(asyncio.ensure_future(self.sendKeepAlives()))
+			if self.stats_interval:
+				tasks.append(asyncio.ensure_future(self.printStats()))
+
+			try:
+				return await self.monitorBus()
+			finally:
+				for task in tasks:
+					task.cancel()
+				self.stop()
+		finally:
+			self.sock.close()
+
+	def stop(self):
+		if self.pipeline:
+			from gi.repository import Gst
+			self.pipeline.set_state(Gst.State.NULL)
+			self.pipeline = None
+
+
 def main():
 	parser = argparse.ArgumentParser(description='RTP client launcher')
 	parser.add_argument('host', help='Remote host address')
@@ -171,8 +487,15 @@ def main():
 	parser.add_argument('-i', '--interface', type=str, help='Force network interface (IP) to use (default=auto)', default=None)
 	parser.add_argument('-p', '--local_port', type=int, help='Force local port to use (default=random)', default=0)
 	parser.add_argument('-t', '--stream_type', type=int, help='Define stream type (e.g. 99) instead of autodetecting', default=0)
+	parser.add_argument('-n', '--detect-packets', type=int, help='Consecutive packets required to detect the stream type (default=3)', default=3)
+	parser.add_argument('-T', '--detect-timeout', type=int, help='Maximum time to detect the stream type in ms (default=5000)', default=5000)
 	parser.add_argument('-v', '--verbose', help='Verbose output', action='store_true')
 	parser.add_argument('-q', '--non-quiet', help='Non-quiet mode, output normal amount of text', action='store_false')
+	parser.add_argument('-l', '--latency', type=int, help='Jitter buffer latency in ms (default=200)', default=200)
+	parser.add_argument('-m', '--jitter-mode', help='Jitter buffer mode (default=slave)', choices=jitter_modes, default='slave')
+	parser.add_argument('-d', '--drop-late', help='Drop packets that arrive later than the jitter buffer latency', action='store_true')
+	parser.add_argument('-k', '--keepalive', type=int, help='Send keep-alive byte to the server every N seconds, 0 = never (default=5)', default=5)
+	parser.add_argument('-s', '--stats', type=int, help='Print jitter buffer statistics every N seconds, 0 = never (default=10)', default=10)
 	args = parser.parse_args()
 
 	host = args.host
@@ -181,19 +504,46 @@ def main():
 	interface = args.interface
 	local_port = args.local_port
 
-	(interface, local_port) = sendStartPacket(host, port, interface, local_port)
-	if not interface:
+	if gstAvailable():
+		session = RTPSession(host, port, interface, local_port, args.stream_type,
+			args.detect_timeout / 1000.0, args.detect_packets, args.latency, args.jitter_mode,
+			args.drop_late, args.stats, args.keepalive, args.verbose)
+		try:
+			ret = asyncio.run(session.run())
+		except KeyboardInterrupt:
+			ret = 0
+		print('RTP client returned {}'.format(ret))
 		return
 
-	stream_type = args.stream_type or detectPayloadType(interface, local_port)
+	# Without the bindings the stream is played with gst-launch-1.0
+	started = time.time()
+	sock = openSocket(host, port, interface, local_port)
+	if not sock:
+		return
+
+	sendStartPacket(sock, host, port)
+	if args.verbose:
+		print('First packet after {:.3f} s'.format(time.time() - started))
+
+	early_packets = None
+	stream_type = args.stream_type
+	if not stream_type:
+		(stream_type, early_packets) = detectPayloadType(sock, args.detect_timeout / 1000.0, args.detect_packets)
+		if args.verbose:
+			print('Stream type detected after {:.3f} s from {} packets'.format(time.time() - started, len(early_packets)))
+
 	if not stream_type:
 		print('Stream type was not detected, timeout')
 	else:
 		print('Payload type: {}'.format(stream_type))
 		print('Launching RTP client')
-		ret = launchRTPClient(interface, local_port, stream_type, verbose=args.verbose, quiet=args.non_quiet)
+		ret = launchRTPClient(sock, host, port, stream_type, verbose=args.verbose, quiet=args.non_quiet,
+			latency=args.latency, jitter_mode=args.jitter_mode, drop_late=args.drop_late, stats_interval=args.stats,
+			early_packets=early_packets, keepalive=args.keepalive)
 		print('RTP client returned {}'.format(ret))
 
+	sock.close()
+
 
 
 if __name__ == '__main__':
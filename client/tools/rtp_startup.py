@@ -0,0 +1,124 @@
+#!/bin/env python3
+
+# rtp_startup.py -- Measure the RTP client startup time and packets lost during it
+# Copyright (C) 2026 Lauri Peltonen
+
+# A local sender waits for the 1-byte start packet and then streams numbered
+# RTP packets at the real rate. The client side runs the handshake and the
+# payload detection of RTPClient, waits --pipeline-delay seconds as if the
+# playback pipeline were starting and then reads the rest of the stream.
+#
+# "single" uses one socket for everything, like RTPClient now does.
+# "reopen" closes and binds the port again between the steps, like RTPClient
+# did before, so the packets arriving in between are lost.
+
+import argparse
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import RTPClient
+
+
+# Stream numbered RTP packets to whoever sends the start byte, for duration seconds
+class Sender(threading.Thread):
+	def __init__(self, duration, interval=0.006, payload_size=1152):
+		threading.Thread.__init__(self, daemon=True)
+		self.duration = duration
+		self.interval = interval	# 1152 bytes of 48 kHz stereo L16 is 6 ms
+		self.payload = bytes(payload_size)
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(('127.0.0.1', 0))
+		self.port = self.sock.getsockname()[1]
+		self.sent = 0
+		self.start()
+
+	def run(self):
+		data, client = self.sock.recvfrom(16)	# Start byte
+		started = time.perf_counter()
+		while time.perf_counter() - started < self.duration:
+			packet = struct.pack('!BBHII', 0x80, 99, self.sent & 0xFFFF, self.sent * 288, 0x1234) + self.payload
+			try:
+				self.sock.sendto(packet, client)
+			except OSError:
+				pass	# ICMP port unreachable from an earlier packet
+			self.sent += 1
+			# Sleep until the next packet is due, so the rate does not drift
+			time.sleep(max(0, started + self.sent * self.interval - time.perf_counter()))
+
+
+# Read packets until the stream has been idle for timeout seconds
+def readStream(sock, timeout=0.5):
+	packets = []
+	sock.settimeout(timeout)
+	try:
+		while True:
+			packets.append(sock.recv(2048))
+	except socket.timeout:
+		pass
+	return packets
+
+
+def bind(port):
+	sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+	sock.bind(('127.0.0.1', port))
+	return sock
+
+
+# Returns (seconds until the packets reach playback, received packets)
+def single(sender, pipeline_delay):
+	started = time.perf_counter()
+	sock = RTPClient.openSocket('127.0.0.1', sender.port)
+	RTPClient.sendStartPacket(sock, '127.0.0.1', sender.port)
+	(stream_type, early_packets) = RTPClient.detectPayloadType(sock)
+
+	time.sleep(pipeline_delay)	# Packets wait in the socket meanwhile
+	startup = time.perf_counter() - started
+	packets = early_packets + readStream(sock)
+	sock.close()
+	return startup, packets
+
+
+def reopen(sender, pipeline_delay):
+	started = time.perf_counter()
+	sock = RTPClient.openSocket('127.0.0.1', sender.port)
+	port = sock.getsockname()[1]
+	RTPClient.sendStartPacket(sock, '127.0.0.1', sender.port)
+	sock.close()
+
+	sock = bind(port)
+	(stream_type, early_packets) = RTPClient.detectPayloadType(sock)
+	sock.close()
+
+	time.sleep(pipeline_delay)	# Port is not bound while the pipeline starts
+	sock = bind(port)
+	startup = time.perf_counter() - started
+	packets = early_packets + readStream(sock)
+	sock.close()
+	return startup, packets
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Measure RTP client startup')
+	parser.add_argument('-n', '--runs', type=int, help='Runs of each mode (default=5)', default=5)
+	parser.add_argument('-d', '--duration', type=float, help='Seconds streamed per run (default=3)', default=3)
+	parser.add_argument('-p', '--pipeline-delay', type=float, help='Seconds the playback pipeline takes to start (default=0.3)', default=0.3)
+	args = parser.parse_args()
+
+	for mode in [reopen, single]:
+		for run in range(args.runs):
+			sender = Sender(args.duration)
+			startup, packets = mode(sender, args.pipeline_delay)
+			sender.join()
+
+			received = set(RTPClient.parseRTPHeader(packet)[1] for packet in packets)
+			print('{:>6} run {}: startup {:.3f} s, sent {}, received {}, lost {}'.format(
+				mode.__name__, run + 1, startup, sender.sent, len(received), sender.sent - len(received)))
+
+
+if __name__ == '__main__':
+	main()
@@ -12,6 +12,14 @@ import subprocess # To launch the apps
 import os
 import signal
 
+# Resource allocation and limits
+import socket
+import resource
+
+# Application listing filters
+import re
+import fnmatch
+
 # XML
 import lxml.etree as ElementTree
 from lxml.etree import Element, SubElement
@@ -22,8 +30,10 @@ import dbus.service
 import dbus.mainloop.glib
 from gi.repository import GLib
 
-# YAML for configuration files
-#import yaml
+from TmSession import sessionPath	# Same object paths as the UPnP server uses
+
+# Modules for the application registry files (json, pickle and the optional
+# yaml) are imported only when a registry is used, to keep the startup fast
 
 # List of remoting protocols
 ApplicationProtocols = [
@@ -50,12 +60,414 @@ ApplicationProtocols = [
 # None = Not used
 
 
+# Application listing filter keys and the application attribute they refer to.
+# Both the plain element name and the parent@element form are accepted.
+FilterKeys = {
+    'appID':                        'appID',
+    'name':                         'name',
+    'protocolID':                   'protocolID',
+    'remotingInfo@protocolID':      'protocolID',
+    'format':                       'format',
+    'remotingInfo@format':          'format',
+    'direction':                    'direction',
+    'remotingInfo@direction':       'direction',
+    'appCategory':                  'appCategory',
+    'appInfo@appCategory':          'appCategory',
+    'appInfo@trustLevel':           'appTrustLevel',
+    'displayInfo@contentCategory':  'displayCategory',
+    'displayInfo@trustLevel':       'displayTrustLevel',
+    'audioType':                    'audioType',
+    'audioInfo@audioType':          'audioType',
+    'audioInfo@contentCategory':    'audioCategory',
+    'hasAudio':                     'hasAudio',
+    'hasDisplay':                   'hasDisplay',
+    'resourceStatus':               'resourceStatus',
+    }
+
+
+class InvalidFilterError(dbus.DBusException, ValueError):
+    """Listing filter could not be parsed, told apart from other errors over D-BUS"""
+    _dbus_error_name = 'org.tmlink.ApplicationServer.InvalidFilter'
+
+
+class AppListingFilter:
+    """Compiled application listing filter
+
+    The filter string is a comma separated list of key="pattern" pairs,
+    e.g. protocolID="VNC",appInfo@appCategory="0xF*". Patterns may contain
+    * and ? wildcards. An application must match all the pairs.
+    """
+
+    termPattern = re.compile(r'\s*([\w@]+)\s*=\s*"([^"]*)"\s*(,|$)')
+
+    def __init__(self, filterString):
+        self.filterString = filterString
+        self.terms = []	# List of (attribute name, compiled pattern)
+
+        pos = 0
+        filterString = filterString.strip()
+        while pos < len(filterString):
+            match = AppListingFilter.termPattern.match(filterString, pos)
+            if not match or match.end() == pos:
+                raise ValueError('Invalid application listing filter: {}'.format(self.filterString))
+
+            key, pattern = match.group(1), match.group(2)
+            if not key in FilterKeys:
+                raise ValueError('Unknown application listing filter key: {}'.format(key))
+
+            # Wildcard only patterns match everything, so they can be skipped
+            if pattern.strip('*'):
+                self.terms.append((FilterKeys[key], re.compile(fnmatch.translate(pattern))))
+            pos = match.end()
+
+    def select(self, index, appIDs):
+        """Return the set of application IDs that match the filter
+
+        index is a dictionary of attribute name -> {value: set of app IDs}
+        """
+        selected = set(appIDs)
+        for attribute, pattern in self.terms:
+            matching = set()
+            for value, ids in index.get(attribute, {}).items():
+                if pattern.match(value):
+                    matching |= ids
+            selected &= matching
+            if not selected:
+                break
+
+        return selected
+
+
+def exitCode(status):
+    """Convert wait() status to exit code like subprocess returncode"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def portFree(host, port, kind=socket.SOCK_DGRAM):
+    """Return True if the port can be bound on the host"""
+    s = socket.socket(socket.AF_INET, kind)
+    try:
+        if kind == socket.SOCK_STREAM:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)	# Ignore TIME_WAIT of a closed server
+        s.bind((host or '', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def displayFree(display):
+    """Return True if no X server has the display"""
+    return not (os.path.exists('/tmp/.X{}-lock'.format(display)) or
+                os.path.exists('/tmp/.X11-unix/X{}'.format(display)))
+
+
+class ResourcePool(object):
+    """X displays and ports leased to the applications of one session
+
+    Each interface served by the same gadget gets its own pool, so that
+    the sessions do not compete for the same VNC screen or RTP port.
+    The resources are probed before leasing, so ones taken by other
+    processes are skipped, and returned to the pool when the app stops.
+    """
+
+    def __init__(self, displays, ports):
+        self.displays = list(displays)
+        self.ports = list(ports)
+        self.leases = {}	# (kind, number) -> application holding it
+
+    @classmethod
+    def forSession(cls, session, displays=8, ports=100):
+        """Non-overlapping pool of the n:th session"""
+        firstDisplay = 1 + session * displays
+        firstPort = 12345 + session * ports
+        return cls(range(firstDisplay, firstDisplay + displays), range(firstPort, firstPort + ports))
+
+    def acquireDisplay(self, owner, host, basePort=5900):
+        """Lease a free display whose VNC port (basePort + display) is also free, None if none left"""
+        for display in self.displays:
+            if ('display', display) in self.leases:
+                continue
+            if displayFree(display) and portFree(host, basePort + display, socket.SOCK_STREAM):
+                self.leases[('display', display)] = owner
+                return display
+        return None
+
+    def acquirePort(self, owner, host, kind=socket.SOCK_DGRAM):
+        """Lease a free port, None if none left"""
+        for port in self.ports:
+            if ('port', port) in self.leases:
+                continue
+            if portFree(host, port, kind):
+                self.leases[('port', port)] = owner
+                return port
+        return None
+
+    def transfer(self, key, owner):
+        """Move the lease of the resource, e.g. ('display', 1), to another owner"""
+        self.leases[key] = owner
+
+    def releaseKey(self, key):
+        self.leases.pop(key, None)
+
+    def release(self, owner):
+        """Return all resources leased by the owner"""
+        for key in [key for key in self.leases if self.leases[key] is owner]:
+            del self.leases[key]
+
+
+def systemMemory():
+    """Total memory in MB"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) // 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+class ResourceLimits(object):
+    """Admission control and CPU / memory limits of the launched applications
+
+    Applications have budgets, cpuBudget in percent of one CPU and
+    memoryBudget in MB, 0 meaning not limited. An app is launched only if
+    its budget fits in what the already running apps have left of the total,
+    which is kept below the whole machine so that the UPnP and SSDP servers
+    stay responsive.
+
+    Each app runs in its own cgroup (v2) under root, where the budgets are
+    the hard limits and the CPU weight is lowered below the servers. If
+    cgroups can not be used (e.g. root not delegated to this user), the apps
+    are only niced and memory limited with RLIMIT_AS.
+
+    One instance is shared by the servers of all the sessions, so it keeps
+    the running apps of all of them and updates their resource status.
+    """
+
+    def __init__(self, cpu=None, memory=None, root='/sys/fs/cgroup/tmlink', nice=10, weight=50, backgroundWeight=1):
+        if cpu is None:
+            cpu = 80 * (os.sysconf('SC_NPROCESSORS_ONLN') or 1)
+        if memory is None:
+            memory = systemMemory() * 3 // 4
+        self.cpu = cpu	# Total of the budgets, percent of one CPU
+        self.memory = memory	# Total of the budgets, MB
+        self.nice = nice
+        self.weight = weight	# cgroup cpu.weight of the apps, servers have default 100
+        self.backgroundWeight = backgroundWeight	# cpu.weight of the apps throttled in background
+
+        self.running = set()	# Apps of all the servers counted in the budget
+        self.servers = []	# ApplicationServers whose apps are admitted here
+
+        self.root = None
+        if root:
+            try:
+                if not os.path.isdir(root):
+                    os.mkdir(root)
+                with open(os.path.join(root, 'cgroup.subtree_control'), 'w') as f:
+                    f.write('+cpu +memory')
+                self.root = root
+            except (IOError, OSError) as e:
+                print('Not using cgroups ({}), applications are only niced'.format(e))
+
+    def addServer(self, server):
+        self.servers.append(server)
+
+    def adopt(self, app):
+        """Count the app, which has just started, in the budget"""
+        self.running.add(app)
+        self.update()
+
+    def stopped(self, app):
+        if app in self.running:
+            self.running.discard(app)
+            self.update()
+
+    def update(self):
+        """Show the apps whose budget does not fit now as busy, in every session"""
+        for server in self.servers:
+            server.updateAdmission()
+
+    def used(self, exclude=None):
+        """Return the (cpu, memory) budget of the running apps"""
+        cpu = memory = 0
+        for app in self.running:
+            if app is not exclude:
+                cpu += app.cpuBudget
+                memory += app.memoryBudget
+        return cpu, memory
+
+    def admit(self, app):
+        """Return True if the budget of the app fits next to the running apps"""
+        cpu, memory = self.used(app)
+        if app.cpuBudget and cpu + app.cpuBudget > self.cpu:
+            return False
+        if app.memoryBudget and self.memory and memory + app.memoryBudget > self.memory:
+            return False
+        return True
+
+    def cgroup(self, app):
+        return os.path.join(self.root, 'app-{:X}'.format(app.appID))
+
+    def prepare(self, app):
+        """Create the cgroup of the app with its limits, returns its path or None"""
+        if self.root is None:
+            return None
+
+        path = self.cgroup(app)
+        try:
+            if not os.path.isdir(path):
+                os.mkdir(path)
+            with open(os.path.join(path, 'cpu.weight'), 'w') as f:
+                f.write(str(self.weight))
+            with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                f.write('{} 100000'.format(app.cpuBudget * 1000) if app.cpuBudget else 'max 100000')
+            with open(os.path.join(path, 'memory.max'), 'w') as f:
+                f.write(str(app.memoryBudget * 1024 * 1024) if app.memoryBudget else 'max')
+            return path
+        except (IOError, OSError) as e:
+            print('Could not set up cgroup of {}: {}'.format(app.name, e))
+            return None
+
+    def preexec(self, app):
+        """Return the function run in the child before exec"""
+        path = self.prepare(app)
+        niceness = app.nice if app.nice is not None else self.nice
+        memoryLimit = app.memoryBudget * 1024 * 1024
+
+        def limit():
+            os.setsid()	# Own process group, so all children can be terminated
+            if path is not None:
+                with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                    f.write('0')	# Moves this process
+            else:
+                if memoryLimit:
+                    resource.setrlimit(resource.RLIMIT_AS, (memoryLimit, memoryLimit))
+            if niceness:
+                os.nice(niceness)
+        return limit
+
+    def attach(self, app, pid):
+        """Move an already started process, e.g. pre-started VNC server, under the limits"""
+        path = self.prepare(app)
+        try:
+            if path is not None:
+                with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                    f.write(str(pid))
+            niceness = app.nice if app.nice is not None else self.nice
+            os.setpriority(os.PRIO_PGRP, pid, niceness)
+        except (IOError, OSError, AttributeError) as e:	# No setpriority in Python 2
+            print('Could not limit {}: {}'.format(app.name, e))
+
+    def release(self, app):
+        """Remove the cgroup of the app, after its processes have exited"""
+        self.stopped(app)
+        if self.root is not None:
+            try:
+                os.rmdir(self.cgroup(app))
+            except OSError:
+                pass	# Not created, or some process is still exiting
+
+    def write(self, app, name, value):
+        """Write a control file in the cgroup of the app, returns False if there is none"""
+        if self.root is None:
+            return False
+        try:
+            with open(os.path.join(self.cgroup(app), name), 'w') as f:
+                f.write(value)
+            return True
+        except (IOError, OSError) as e:
+            print('Could not write {} of {}: {}'.format(name, app.name, e))
+            return False
+
+    def signalGroup(self, app, signum):
+        try:
+            os.killpg(os.getpgid(app.proc.pid), signum)
+        except OSError:
+            pass	# Exited, the server is told about it separately
+
+    def canRenice(self, niceness):
+        """Return True if the niceness can be lowered back to the given one"""
+        if os.geteuid() == 0:
+            return True
+        try:
+            limit = resource.getrlimit(resource.RLIMIT_NICE)[0]
+        except (AttributeError, ValueError):
+            return False
+        return limit == resource.RLIM_INFINITY or 20 - limit <= niceness
+
+    def renice(self, app, niceness):
+        try:
+            os.setpriority(os.PRIO_PGRP, os.getpgid(app.proc.pid), niceness)
+        except (OSError, AttributeError) as e:	# Lowering needs CAP_SYS_NICE
+            print('Could not renice {}: {}'.format(app.name, e))
+
+    def throttle(self, app, mode):
+        """Slow down or pause an app sent to background, returns the mode used
+
+        freeze uses the cgroup freezer, and falls back to stopping the process
+        group without cgroups. weight lowers the cgroup CPU weight, or the
+        priority, so the app still runs but only on cycles left over.
+        """
+        if mode == 'freeze':
+            if self.write(app, 'cgroup.freeze', '1'):
+                return mode
+            mode = 'stop'
+
+        if mode == 'stop':
+            self.signalGroup(app, signal.SIGSTOP)
+        elif mode == 'weight':
+            if not self.write(app, 'cpu.weight', str(self.backgroundWeight)):
+                # Without CAP_SYS_NICE the app would be stuck at the low priority
+                if not self.canRenice(app.nice if app.nice is not None else self.nice):
+                    print('Not throttling {}, its priority could not be restored'.format(app.name))
+                    return None
+                self.renice(app, 19)
+        else:
+            return None
+        return mode
+
+    def resume(self, app, mode):
+        """Undo throttle when the app comes to foreground or is terminated"""
+        if mode == 'freeze':
+            self.write(app, 'cgroup.freeze', '0')
+        elif mode == 'stop':
+            self.signalGroup(app, signal.SIGCONT)
+        elif mode == 'weight':
+            if not self.write(app, 'cpu.weight', str(self.weight)):
+                self.renice(app, app.nice if app.nice is not None else self.nice)
+
+
+def filterValue(value):
+    """Convert an attribute value to the string used in filter matching"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if value is None:
+        return ''
+    return str(value)
+
 
 # Minimal required implementation
-class Application:
+class Application(object):
     nextAppID = 1
 
+    # Attributes that are shown in the application listing XML. Changing
+    # any of these invalidates the cached listing of the server.
+    listingAttributes = frozenset([
+        'appID', 'name', 'noListing',
+        'protocolID', 'format', 'direction',
+        'hasAppInfo', 'appCategory', 'appTrustLevel',
+        'hasDisplay', 'displayCategory', 'displayTrustLevel',
+        'hasAudio', 'audioType', 'audioCategory',
+        'resourceStatus'])
+
     def __init__(self, host = None):
+        self.server = None	# ApplicationServer this app is registered to
+
         self.appID = Application.nextAppID
         Application.nextAppID += 1
 
@@ -64,6 +476,7 @@ class Application:
         self.noListing = False # True = Do not list this in the app listing (e.g. background servers)
 
         self.proc = None
+        self.pool = None	# ResourcePool the app leases its display and ports from
 
         # XML Output string
         self.xmlTree = None
@@ -97,6 +510,17 @@ class Application:
         self.audioTrustLevel = '0x0000'
 
         self.resourceStatus = 'free' # free, busy or NA, is the app available. If None, not printed
+
+        # Resource budgets, see ResourceLimits, 0 = not limited
+        self.cpuBudget = 0	# Percent of one CPU
+        self.memoryBudget = 0	# MB
+        self.nice = None	# None = default of the server
+        self.limits = None	# ResourceLimits the app was started under
+
+        # What is done to the app in background: none, stop, freeze or weight,
+        # see ResourceLimits.throttle
+        self.backgroundMode = 'none'
+        self.throttled = None	# Mode the app is currently throttled with
         #self.signature = 'xx'       # Not implemented in 1.0
 
         self.uri = ''	# Uri to access the application
@@ -106,6 +530,23 @@ class Application:
 	#self.createXML()
 
 
+    def __setattr__(self, name, value):
+        changed = self.__dict__.get(name) != value
+        object.__setattr__(self, name, value)
+        if changed:
+            if name in Application.listingAttributes:
+                self.invalidate()
+            elif name == 'status':
+                server = self.__dict__.get('server')
+                if server is not None:
+                    server.statusChanged(self)
+
+    def invalidate(self):
+        """Tell the server that the listing of this app has changed"""
+        server = self.__dict__.get('server')
+        if server is not None:
+            server.invalidateList(self)
+
     def createXML(self):
         self.xmlTree = Element('app')
         SubElement(self.xmlTree, 'appID').text = '0x{:0X}'.format(self.appID)
@@ -156,40 +597,134 @@ class Application:
             self.foreground()
             return self.uri
 
+        if not self.admitted():
+            # Subclasses check before leasing, but do not leave a lease behind
+            if self.pool is not None:
+                self.pool.release(self)
+            self.uri = ''
+            return ''
+
+        preexec = os.setsid
+        if self.server is not None:
+            preexec = self.server.limits.preexec(self)
+
         print('Launching: {}'.format(' '.join(x for x in command)))
-        self.proc = subprocess.Popen(command, preexec_fn=os.setsid, env=environ)
+        try:
+            proc = subprocess.Popen(command, preexec_fn=preexec, env=environ)
+        except OSError as e:
+            print('Launching {} failed: {}'.format(self.name, e))
+            self.stopped()
+            if self.server is not None:
+                self.server.limits.release(self)
+            return ''
+
+        return self.adopt(proc)
+
+    def admitted(self):
+        """Return True if the budget of the app allows launching it now"""
+        if self.server is None or self.server.limits.admit(self):
+            return True
+        print('Not launching {}, its resource budget does not fit'.format(self.name))
+        return False
+
+    def adopt(self, proc):
+        """Make the already started process the process of this app"""
+        self.proc = proc
         self.status = 'Foreground'
+        if self.resourceStatus:
+            self.resourceStatus = 'busy'
+
+        # Let the server follow the process so status is updated when it exits
+        if self.server is not None:
+            self.server.supervise(self)
+            self.limits = self.server.limits
+            self.limits.adopt(self)
+
         return self.uri
 
-    def terminate(self):
-        if not self.proc or self.noTerminate:
+    def terminate(self, force=False):
+        """Terminate the app, force also terminates noTerminate apps e.g. on shutdown"""
+        if not self.proc or (self.noTerminate and not force):
             return False
 
         #self.proc.terminate()
         #self.proc.kill()
 
-        # Kill the process group, i.e. also all children
-        os.killpg(os.getpgid(self.proc.pid), signal.SIGTERM)
+        # Stopped or frozen processes would not handle SIGTERM
+        self.resume()
+
+        # Kill the process group, i.e. also all children. The app leads its own
+        # group (setsid at launch), which outlives the app if it already exited.
+        try:
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        except OSError:
+            pass	# Whole group has exited
+
+        self.stopped()
+        return True
+
+    def processExited(self, proc):
+        # Only update the app if it was not terminated or relaunched meanwhile
+        if self.proc is proc:
+            self.stopped()
 
+        # The cgroup can be removed only after its processes have exited,
+        # i.e. not yet when the app is terminated. The app may have been
+        # removed from the server meanwhile.
+        if self.proc is None and self.limits is not None:
+            self.limits.release(self)
+
+    def stopped(self):
+        """Mark the application as not running"""
         self.proc = None
+        self.throttled = None
+        if self.pool is not None:
+            self.pool.release(self)
         self.status = 'Notrunning'
-        return True
+        if self.resourceStatus:
+            self.resourceStatus = 'free'
+        if self.limits is not None:
+            self.limits.stopped(self)
 
     def isRunning(self):
         if not self.proc:
             return False
+        if self.server is not None:	# Exit is tracked by the server, see ApplicationServer.childExited
+            return True
         if self.proc.poll() == None:
             return True
         return False
 
+    def uses(self):
+        """Return the apps that must keep running while this one is on foreground"""
+        return [self]
+
     def foreground(self):
-        # TODO: Use wmctrl or xdotool to bring the window to foreground (if PID is stored in data)
-        # Program is now on foreground
+        """Let the app run at full speed again and show it, returns False if not running"""
+        if not self.proc:
+            return False
+        self.resume()
+        self.raiseWindow()
         self.status = 'Foreground'
+        return True
 
     def background(self):
-        # TODO: Use wmctrl or xdotool to send the window to background (if PID is stored in data)
+        """Throttle the app according to backgroundMode, returns False if not running"""
+        if not self.proc:
+            return False
+        if self.throttled is None and self.server is not None:
+            self.throttled = self.server.limits.throttle(self, self.backgroundMode)
         self.status = 'Background'
+        return True
+
+    def resume(self):
+        if self.throttled is not None and self.server is not None:
+            self.server.limits.resume(self, self.throttled)
+        self.throttled = None
+
+    def raiseWindow(self):
+        """Bring the windows of the app on top, servers have nothing to show"""
+        pass
 
     def getURI(self):
         return self.uri
@@ -207,10 +742,102 @@ class Application:
         return self.xmlStatus
 
 
-class VNCApplication(Application):
-    vncScreen = 1
+def vncCommand(host, display, port, geometry):
+    # TODO: without -interface the server listens on all interfaces
+    return ['vncserver', '-SecurityTypes=None', '-geometry={}'.format(geometry), '-interface={}'.format(host), '-localhost=0', '--I-KNOW-THIS-IS-INSECURE', '-rfbport={}'.format(port), '-fg', ':{}'.format(display)]
+
+
+class VNCServerPool(object):
+    """Idle VNC servers started in advance, so that launching a VNC app
+    does not have to wait for Xvnc to start
+
+    At most size servers are kept idle, and only as many as there are VNC
+    apps not running, so e.g. the auto launched VNC app takes the only one
+    instead of leaving an extra idle server.
+    """
 
-    def __init__(self, host):
+    def __init__(self, server, size=1, geometry='800x600', retryDelay=5):
+        self.server = server
+        self.name = 'VNC pool'
+        self.size = size
+        self.geometry = geometry
+        self.retryDelay = retryDelay	# s, before replacing a server that exited by itself
+        self.idle = []	# List of (display, Popen)
+        self.warmSource = None
+
+        # Started when the apps are added
+
+    def scheduleWarm(self, delay=0):
+        if self.warmSource is None:
+            if delay:
+                self.warmSource = GLib.timeout_add_seconds(delay, self.warm)
+            else:
+                self.warmSource = GLib.idle_add(self.warm)
+
+    def wanted(self):
+        """Return the number of idle servers to keep"""
+        stopped = [app for app in self.server.apps.values() if isinstance(app, VNCApplication) and not app.proc]
+        return min(self.size, len(stopped))
+
+    def warm(self):
+        """Start servers until there are enough idle ones"""
+        self.warmSource = None
+        while len(self.idle) < self.wanted():
+            display = self.server.pool.acquireDisplay(self, self.server.host)
+            if display is None:
+                break
+
+            command = vncCommand(self.server.host, display, 5900 + display, self.geometry)
+            print('Pre-starting: {}'.format(' '.join(x for x in command)))
+            try:
+                proc = subprocess.Popen(command, preexec_fn=os.setsid)
+            except OSError as e:
+                print('Pre-starting VNC server failed: {}'.format(e))
+                self.server.pool.releaseKey(('display', display))	# Idle servers keep theirs
+                break
+
+            self.idle.append((display, proc))
+            self.server.superviseProcess(self, proc)
+
+        return False	# Do not repeat
+
+    def take(self, owner, geometry):
+        """Hand an idle server over to the owner, returns (display, Popen) or None"""
+        if geometry != self.geometry:
+            return None
+
+        # E.g. auto launch right after the app was added, start it now
+        if not self.idle and self.warmSource is not None:
+            GLib.source_remove(self.warmSource)
+            self.warm()
+        if not self.idle:
+            return None
+
+        display, proc = self.idle.pop(0)
+        self.server.pool.transfer(('display', display), owner)
+        self.scheduleWarm()	# Replace the one taken, if other apps may need it
+        return display, proc
+
+    def processExited(self, proc):
+        for n, (display, idleProc) in enumerate(self.idle):
+            if idleProc is proc:
+                del self.idle[n]
+                self.server.pool.releaseKey(('display', display))
+                self.scheduleWarm(self.retryDelay)
+                return
+
+    def stop(self):
+        """Terminate the idle servers"""
+        self.size = 0
+        for display, proc in self.idle:
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)	# Started with setsid
+            except OSError:
+                pass
+
+
+class VNCApplication(Application):
+    def __init__(self, host, pool):
         #super(VNCApplication, self).__init__(host)
         Application.__init__(self, host)
 
@@ -219,33 +846,64 @@ class VNCApplication(Application):
         self.hasAudio = False
         self.hasAppInfo = True
 
-        # Select next free screen number
-        self.screenID = VNCApplication.vncScreen
-        VNCApplication.vncScreen += 1
-
-        # Select port
-        self.port = 5900 + self.screenID
-
-        self.uri = 'vnc://{}:{}'.format(self.host, self.port)
+        # Screen, port and URI are allocated from the pool at launch
+        self.pool = pool
+        self.screenID = None
+        self.port = None
+        self.geometry = '800x600'
 
         self.proc = None
 
         #self.createXML()
 
     def launch(self):
-        # TODO: without -interface the server listens on all interfaces
+        if self.proc:
+            return Application.launch(self, None)
+
+        # Nothing is leased for an app that may not be launched
+        if not self.admitted():
+            return ''
+
+        # Use an already started server if there is one
+        vncPool = self.server.vncPool if self.server is not None else None
+        warm = None
+        if vncPool is not None:
+            warm = vncPool.take(self, self.geometry)
+        if warm is not None:
+            self.screenID, proc = warm
+            self.port = 5900 + self.screenID
+            self.uri = 'vnc://{}:{}'.format(self.host, self.port)
+            print('Using pre-started VNC server on :{}'.format(self.screenID))
+            self.server.limits.attach(self, proc.pid)
+            return self.adopt(proc)
+
+        self.screenID = self.pool.acquireDisplay(self, self.host)
+        if self.screenID is None:
+            print('No free display for {}'.format(self.name))
+            return ''
+        self.port = 5900 + self.screenID
+        self.uri = 'vnc://{}:{}'.format(self.host, self.port)
+
         # Add also the process to a process group, so we can terminate all the child processes
         # too, and the server closes cleanly
-        return Application.launch(self, ['vncserver', '-SecurityTypes=None', '-geometry=800x600', '-interface={}'.format(self.host), '-localhost=0', '--I-KNOW-THIS-IS-INSECURE', '-rfbport={}'.format(self.port), '-fg', ':{}'.format(self.screenID)])
+        return Application.launch(self, vncCommand(self.host, self.screenID, self.port, self.geometry))
+
+    def stopped(self):
+        Application.stopped(self)
+        # Have a server ready for launching it again
+        if self.server is not None and self.server.vncPool is not None:
+            self.server.vncPool.scheduleWarm()
 
 
 
 class RTPServerApplication(Application):
-    def __init__(self, host):
+    def __init__(self, host, pool):
         #super(RTPApplication, self).__init__()
         Application.__init__(self, host)
 
-        self.port = 12345	# TODO: Change to correct one
+        self.pool = pool
+        self.port = None	# Allocated at launch
+        self.expire = 30	# s, clients that stop sending keep-alive bytes are dropped
 
         self.protocolID = 'RTP'
         self.format = '99'
@@ -253,20 +911,30 @@ class RTPServerApplication(Application):
         self.hasAudio = True
         self.audioType = 'application'
         self.hasAppInfo = True
-        self.uri = 'rtp://{}:{}'.format(self.host, self.port)
 
         #self.createXML()
 
     def launch(self):
-        return Application.launch(self, ['python', 'RTPServer.py', '--interface={}'.format(self.host), '--port={}'.format(self.port)])
+        if not self.proc:
+            if not self.admitted():	# Nothing is leased for an app that may not be launched
+                return ''
+            self.port = self.pool.acquirePort(self, self.host)
+            if self.port is None:
+                print('No free port for {}'.format(self.name))
+                return ''
+            self.uri = 'rtp://{}:{}'.format(self.host, self.port)
+
+        return Application.launch(self, ['python', 'RTPServer.py', '--interface={}'.format(self.host), '--port={}'.format(self.port),
+                                         '--expire={}'.format(self.expire)])
 
 
 class RTPClientApplication(Application):
-    def __init__(self, host):
+    def __init__(self, host, pool):
         #super(RTPApplication, self).__init__()
         Application.__init__(self, host)
 
-        self.port = 12346	# TODO: Change to correct one
+        self.pool = pool
+        self.port = None	# Allocated at launch
 
         self.protocolID = 'RTP'
         self.format = '99'
@@ -274,86 +942,325 @@ class RTPClientApplication(Application):
         self.hasAudio = True
         self.audioType = 'application'
         self.hasAppInfo = True
-        self.uri = 'rtp://{}:{}'.format(self.host, self.port)
 
         self.stream_type = 'application/x-rtp, media=audio, format=S32LE, layout=interleaved, clock-rate=48000, channels=2, payload=99'
 
         #self.createXML()
 
     def launch(self):
+        if not self.proc:
+            if not self.admitted():	# Nothing is leased for an app that may not be launched
+                return ''
+            self.port = self.pool.acquirePort(self, self.host)
+            if self.port is None:
+                print('No free port for {}'.format(self.name))
+                return ''
+            self.uri = 'rtp://{}:{}'.format(self.host, self.port)
+
         return Application.launch(self, ['gst-launch-1.0', 'udpsrc', 'port={}'.format(self.port), 'caps=\"{}\"'.format(self.stream_type), '!', 'rtpL16depay', '!', 'alsasink device=hw:1,1,1'])
 
 
 class GenericApplication(Application):
-    def __init__(self, command, uri, display=1):
+    def __init__(self, command, parent, display=None):
+        """Application shown through the parent (e.g. VNC or RTP server) application
+
+        If display is None, the display of the parent is used.
+        """
         Application.__init__(self)
 
         self.hasDisplay = True
         self.hasAudio = False	# This does not provide audio stream
 
         self.command = command
-        self.uri = uri
+        self.parent = parent
         self.display = display
 
+    def displayNumber(self):
+        if self.display is None:
+            return self.parent.screenID
+        return self.display
+
+    def uses(self):
+        return [self] + self.parent.uses()
+
+    def raiseWindow(self):
+        # The window is found by the PID the app sets in _NET_WM_PID
+        env = os.environ.copy()
+        env['DISPLAY'] = ':{}'.format(self.displayNumber())
+        with open(os.devnull, 'w') as devnull:
+            try:
+                proc = subprocess.Popen(['xdotool', 'search', '--pid', str(self.proc.pid), 'windowraise', '%@'],
+                                        env=env, stdout=devnull, stderr=devnull)
+            except OSError as e:
+                print('Could not raise {}: {}'.format(self.name, e))
+                return
+
+        # Not waited for in the main loop, the server reaps it. processExited
+        # ignores it, as it is not the process of the app.
+        if self.server is not None:
+            self.server.superviseProcess(self, proc)
+
     def launch(self):
+        if not self.proc:
+            # URI and display are known only after the parent has been launched
+            if not self.parent.isRunning() and not self.parent.launch():
+                return ''
+            self.uri = self.parent.uri
+
         env = os.environ.copy()
-        env['DISPLAY'] = ':{}'.format(self.display)  # Which display to use
+        env['DISPLAY'] = ':{}'.format(self.displayNumber())  # Which display to use
         return Application.launch(self, self.command, env)
 
 
 class ApplicationServer(dbus.service.Object):
     """Server that handles listing, launching, terminating etc. applications"""
 
-    def __init__(self, host):
-        self.busName = dbus.service.BusName('org.tmlink', bus=dbus.SessionBus())
-        dbus.service.Object.__init__(self, self.busName, '/org/tmlink')
+    def __init__(self, host, bus=True, session=0, vncPool=0, limits=None):
+        # Without bus the server is only used in-process, e.g. from the UPnP server
+        if bus:
+            # Servers of all the sessions share the bus name
+            self.busName = dbus.service.BusName('org.tmlink', bus=dbus.SessionBus())
+            dbus.service.Object.__init__(self, self.busName, sessionPath(session))
+        else:
+            self.busName = None
+            dbus.service.Object.__init__(self)
 
         self.apps = {}
         self.xmlTree = None
-        self.xmlString = ''
+        self.xmlString = None	# Cached application listing, None when stale
+        self.listVersion = 0	# Incremented every time the listing changes
+
+        self.filters = {}	# Compiled filters, filter string -> AppListingFilter
+        self.filterCache = {}	# Filtered listings, filter string -> XML string
+        self.index = None	# Attribute -> {value: set of app IDs}, None when stale
+
+        self.children = {}	# Supervised processes, pid -> (app, Popen)
+
+        # Changes are collected and signalled once per event window
+        self.eventWindow = 50	# ms
+        self.eventSource = None	# GLib timeout source of the pending events
+        self.pendingStatus = set()	# App IDs whose status changed
+        self.pendingList = set()	# App IDs whose listing changed
+        self.listeners = []	# In-process receivers of the change events
 
         self.host = host
+        self.session = session
+        self.pool = ResourcePool.forSession(session)	# Displays and ports of this session's apps
+
+        # Admission control and limits of the launched apps, shared by the sessions
+        self.limits = limits if limits is not None else ResourceLimits()
+        self.limits.addServer(self)
+
+        # Pre-started VNC servers handed out to the VNC apps
+        self.vncPool = None
+        if vncPool > 0:
+            self.vncPool = VNCServerPool(self, vncPool)
+
 
+    def removeApplication(self, app):
+        """Stop the app and remove it from the listing"""
+        if app.proc:
+            app.terminate(force=True)
+
+        # Remove its cgroup, or if the processes are still exiting, processExited does
+        self.limits.release(app)
+
+        if self.apps.pop(app.appID, None) is not None:
+            self.invalidateList(app)
+            app.server = None
 
     def addApplication(self, app):
         #self.apps.append(app)
         appID = app.appID
         if not appID in self.apps:
             self.apps[appID] = app
+            app.server = self
+            self.invalidateList(app)
+
+            if self.vncPool is not None and isinstance(app, VNCApplication):
+                self.vncPool.scheduleWarm()
 
             if app.autoLaunch:
                 self.LaunchApplication('0x{:X}'.format(appID))
 
-    def terminateAll(self):
-        for appID in self.apps:
-            self.apps[appID].terminate()
-
-
-    def createXML(self):
+    def terminateAll(self, force=False):
+        """Terminate the running apps, force also the noTerminate ones, e.g. on shutdown"""
+        for app in list(self.apps.values()):
+            app.terminate(force)
+        if self.vncPool is not None:
+            self.vncPool.stop()
+
+    def updateAdmission(self):
+        """Show the apps whose budget does not fit now as busy"""
+        for app in self.apps.values():
+            if app.proc or not app.resourceStatus:
+                continue
+            app.resourceStatus = 'free' if self.limits.admit(app) else 'busy'
+
+    def supervise(self, app):
+        """Watch the process of the app from the main loop until it exits"""
+        self.superviseProcess(app, app.proc)
+
+    def superviseProcess(self, owner, proc):
+        """Watch the process until it exits, then call owner.processExited(proc)
+
+        The process can be handed over to another owner by supervising it again.
+        """
+        watched = proc.pid in self.children
+        self.children[proc.pid] = (owner, proc)	# Keep Popen alive so subprocess does not reap it
+        if not watched:
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, proc.pid, self.childExited)
+
+    def childExited(self, pid, status):
+        """Called by GLib after a supervised process exited and was reaped"""
+        owner, proc = self.children.pop(pid, (None, None))
+        if proc is None:
+            return
+
+        # GLib already reaped the process, tell Popen so it does not try again
+        proc.returncode = exitCode(status)
+        print('Process {} of {} exited with {}'.format(pid, owner.name, proc.returncode))
+
+        owner.processExited(proc)
+
+
+    def createXML(self, appIDs=None):
+        """Build the listing XML, optionally only of the given app IDs"""
         self.xmlTree = Element('appList')
         self.xmlTree.set('{http://www.w3.org/XML/1998/namespace}id', 'mlServerAppList')	# attribute becomes 'xml:id' as it should
 
         for id in self.apps:
+            if appIDs is not None and not id in appIDs:
+                continue
             if self.apps[id].noListing == False:
                 self.xmlTree.append(self.apps[id].dump())
 
 
-    def dump(self):
-        self.createXML()
+    def dump(self, appIDs=None):
+        self.createXML(appIDs)
         return self.xmlTree
 
+    def invalidateList(self, app=None):
+        """Drop the cached application listings and bump the list version"""
+        self.listVersion += 1
+        self.xmlString = None
+        self.filterCache = {}
+        self.index = None
+
+        if app is not None:
+            self.pendingList.add(app.appID)
+            self.scheduleEvents()
+
+    def addListener(self, listener):
+        """Add in-process listener of the same changes that are signalled on D-BUS
+
+        Listener must have applicationListChanged(appIDs) and
+        applicationStatusChanged(appIDs) methods.
+        """
+        self.listeners.append(listener)
+
+    def statusChanged(self, app):
+        """Queue status change notification of the app"""
+        self.pendingStatus.add(app.appID)
+        self.scheduleEvents()
+
+    def scheduleEvents(self):
+        """Send the pending notifications after the event window"""
+        if self.eventSource is None:
+            self.eventSource = GLib.timeout_add(self.eventWindow, self.flushEvents)
+
+    def flushEvents(self):
+        """Emit the collected changes as one signal of each type"""
+        self.eventSource = None
+
+        if self.pendingList:
+            appIDs = ','.join('0x{:X}'.format(id) for id in sorted(self.pendingList))
+            self.pendingList = set()
+            self.ApplicationListChanged(appIDs)
+            for listener in self.listeners:
+                listener.applicationListChanged(appIDs)
+
+        if self.pendingStatus:
+            appIDs = ','.join('0x{:X}'.format(id) for id in sorted(self.pendingStatus))
+            self.pendingStatus = set()
+            self.ApplicationStatusChanged(appIDs)
+            for listener in self.listeners:
+                listener.applicationStatusChanged(appIDs)
+
+        return False	# Do not repeat the timeout
+
+    def buildIndex(self):
+        """Index the listed applications by their filterable attributes"""
+        self.index = {}
+        for attribute in set(FilterKeys.values()):
+            values = {}
+            for id in self.apps:
+                if self.apps[id].noListing:
+                    continue
+                value = getattr(self.apps[id], attribute)
+                if attribute == 'appID':
+                    value = '0x{:X}'.format(value)
+                values.setdefault(filterValue(value), set()).add(id)
+            self.index[attribute] = values
+
+    def compileFilter(self, filterString):
+        """Return the compiled filter for the filter string, compile only once"""
+        if not filterString in self.filters:
+            if len(self.filters) >= 32:	# Keep the cache bounded
+                self.filters = {}
+            self.filters[filterString] = AppListingFilter(filterString)
+        return self.filters[filterString]
+
+    def listing(self, filterString='', profileID=0):
+        """Return the serialized application listing, rebuilt only when stale"""
+        filterString = filterString.strip()
+        if not filterString or filterString == '*':
+            if self.xmlString is None:
+                self.xmlString = ElementTree.tostring(self.dump(), encoding='UTF-8', method='xml', xml_declaration=True)
+            return self.xmlString
+
+        # Profiles do not affect the listing
+        key = filterString
+        if not key in self.filterCache:
+            appFilter = self.compileFilter(filterString)
+            if self.index is None:
+                self.buildIndex()
+
+            appIDs = appFilter.select(self.index, self.apps.keys())
+            if len(self.filterCache) >= 32:
+                self.filterCache = {}
+            self.filterCache[key] = ElementTree.tostring(self.dump(appIDs), encoding='UTF-8', method='xml', xml_declaration=True)
+
+        return self.filterCache[key]
+
     @dbus.service.method('org.tmlink.ApplicationServer', in_signature='b', out_signature='b')
     def KillServer(self, killApps):
         if killApps:
-            self.terminateAll()
+            self.terminateAll(force=True)
         glib.MainLoop.quit()
         return True
 
 
-    @dbus.service.method('org.tmlink.ApplicationServer', in_signature='', out_signature='s')
-    def ApplicationList(self):
-        self.xmlString = ElementTree.tostring(self.dump(), encoding='UTF-8', method='xml', xml_declaration=True)
-        return self.xmlString
+    @dbus.service.method('org.tmlink.ApplicationServer', in_signature='su', out_signature='s')
+    def ApplicationList(self, appListingFilter, profileID):
+        try:
+            return self.listing(appListingFilter, profileID)
+        except ValueError as e:
+            raise InvalidFilterError(str(e))
+
+    @dbus.service.method('org.tmlink.ApplicationServer', in_signature='', out_signature='u')
+    def ApplicationListVersion(self):
+        return self.listVersion
+
+    @dbus.service.signal('org.tmlink.ApplicationServer', signature='s')
+    def ApplicationListChanged(self, appIDs):
+        """Comma separated list of apps whose listing has changed"""
+        pass
+
+    @dbus.service.signal('org.tmlink.ApplicationServer', signature='s')
+    def ApplicationStatusChanged(self, appIDs):
+        """Comma separated list of apps whose status has changed"""
+        pass
 
     @dbus.service.method('org.tmlink.ApplicationServer', in_signature='s', out_signature='s')
     def LaunchApplication(self, appID):
@@ -381,7 +1288,7 @@ class ApplicationServer(dbus.service.Object):
             if not self.apps[appID].noTerminate:
                 return self.apps[appID].terminate()
             else:
-                self.background(appID)
+                self.BackgroundApplication(appID)
                 return True
 
         return False
@@ -392,14 +1299,16 @@ class ApplicationServer(dbus.service.Object):
         if not appID in self.apps:
             return False
 
-        ret = False
+        # The apps the foreground app is shown through are not throttled
+        uses = self.apps[appID].uses()
         for id in self.apps:
-            if id == appID:
-                ret = self.apps[id].foreground()
+            if self.apps[id] in uses:
+                if self.apps[id].isRunning():
+                    self.apps[id].foreground()
             else:
                 self.apps[id].background()
 
-        return ret
+        return self.apps[appID].isRunning()
 
     @dbus.service.method('org.tmlink.ApplicationServer', in_signature='i', out_signature='b')
     def BackgroundApplication(self, appID):
@@ -433,7 +1342,7 @@ class DefaultApplicationList():
 
     def __init__(self, server, host_address):
         # Default VNC server
-        self.VNCapp = VNCApplication(host_address)
+        self.VNCapp = VNCApplication(host_address, server.pool)
         self.VNCapp.appCategory = '0xF0000001'	# Server functionality
         self.VNCapp.name = 'VNC'
         self.VNCapp.autoLaunch = True
@@ -442,7 +1351,7 @@ class DefaultApplicationList():
         server.addApplication(self.VNCapp)
 
         # RTP server (audio out)
-        self.RTPserver = RTPServerApplication(host_address)
+        self.RTPserver = RTPServerApplication(host_address, server.pool)
         self.RTPserver.appCategory = '0xF0000001'	# Server functionality
         self.RTPserver.name = 'Audio out'
         self.RTPserver.audioType = 'all'
@@ -450,7 +1359,7 @@ class DefaultApplicationList():
         server.addApplication(self.RTPserver)
 
         # RTP sink (audio in)
-        self.RTPclient = RTPClientApplication(host_address)
+        self.RTPclient = RTPClientApplication(host_address, server.pool)
         self.RTPclient.appCategory = '0xF0000002'	# Client functionality
         self.RTPclient.name = 'Audio in'
         self.RTPclient.audioType = 'all'
@@ -458,35 +1367,318 @@ class DefaultApplicationList():
         server.addApplication(self.RTPclient)
 
         # Generic test apps
-        self.genapp = GenericApplication(['gnome-text-editor'], self.VNCapp.uri, 1)
+        self.genapp = GenericApplication(['gnome-text-editor'], self.VNCapp)
         self.genapp.name = 'Text editor'
+        self.genapp.backgroundMode = 'weight'	# Only drawn when on foreground
         server.addApplication(self.genapp)
 
-        self.genapp2 = GenericApplication(['rxvt'], self.VNCapp.uri, 1)
+        self.genapp2 = GenericApplication(['rxvt'], self.VNCapp)
         self.genapp2.name = 'Terminal'
+        self.genapp2.backgroundMode = 'freeze'
         server.addApplication(self.genapp2)
 
-        self.genapp3 = GenericApplication(['sh', 'play_music.sh'], self.RTPserver.uri, 0)
-        self.genapp3.name = 'Play music'
+        self.genapp3 = GenericApplication(['sh', 'play_music.sh'], self.RTPserver, 0)
+        self.genapp3.name = 'Play music'	# Keeps playing in background, not throttled
         server.addApplication(self.genapp3)
 
 
 
 
+# Application types of the registry file and their classes
+RegistryTypes = {
+    'VNC':          VNCApplication,
+    'RTPServer':    RTPServerApplication,
+    'RTPClient':    RTPClientApplication,
+    'Generic':      GenericApplication,
+    }
+
+# Entry keys that need the app to be created again when they change
+RegistryStructure = frozenset(['id', 'type', 'command', 'parent', 'display', 'geometry'])
+
+# Entry keys that are set directly as application attributes, and their types
+RegistryAttributes = {
+    'name':                 str,
+    'format':               str,
+    'direction':            str,
+    'appCategory':          str,
+    'appTrustLevel':        str,
+    'displayCategory':      str,
+    'displayTrustLevel':    str,
+    'audioType':            str,
+    'audioCategory':        str,
+    'autoLaunch':           bool,
+    'noTerminate':          bool,
+    'noListing':            bool,
+    'cpuBudget':            int,
+    'memoryBudget':         int,
+    'nice':                 int,
+    'backgroundMode':       str,
+    }
+
+BackgroundModes = ('none', 'stop', 'freeze', 'weight')
+
+
+def validateEntry(entry):
+    """Check one application entry of the registry file, returns it normalized"""
+    if not isinstance(entry, dict) or not 'id' in entry:
+        raise ValueError('Application entry without id: {}'.format(entry))
+    appID = entry['id']
+
+    if not entry.get('type') in RegistryTypes:
+        raise ValueError('Application {}: type must be one of {}'.format(appID, ', '.join(sorted(RegistryTypes))))
+
+    normalized = {}
+    for key, value in entry.items():
+        if key in RegistryAttributes:
+            if RegistryAttributes[key] is str and not isinstance(value, (type(''), type(u''))):
+                raise ValueError('Application {}: {} must be a string, quote e.g. hex categories'.format(appID, key))
+            if RegistryAttributes[key] is bool and not isinstance(value, bool):
+                raise ValueError('Application {}: {} must be true or false'.format(appID, key))
+            if RegistryAttributes[key] is int and (isinstance(value, bool) or not isinstance(value, int)):
+                raise ValueError('Application {}: {} must be a number'.format(appID, key))
+            normalized[key] = value
+        elif key == 'parent':
+            if not isinstance(value, (type(''), type(u''))):
+                raise ValueError('Application {}: parent must be the id of another application'.format(appID))
+            normalized[key] = value
+        elif key in ('id', 'type', 'geometry'):
+            normalized[key] = str(value)
+        elif key == 'command':
+            if not isinstance(value, list) or not value:
+                raise ValueError('Application {}: command must be a list of arguments'.format(appID))
+            normalized[key] = [str(arg) for arg in value]
+        elif key == 'display':
+            normalized[key] = int(value)
+        else:
+            raise ValueError('Application {}: unknown key {}'.format(appID, key))
+
+    if normalized.get('backgroundMode', 'none') not in BackgroundModes:
+        raise ValueError('Application {}: backgroundMode must be one of {}'.format(appID, ', '.join(BackgroundModes)))
+
+    if normalized['type'] == 'Generic' and not ('command' in normalized and 'parent' in normalized):
+        raise ValueError('Application {}: Generic application needs command and parent'.format(appID))
+    if normalized['type'] != 'Generic' and 'parent' in normalized:
+        raise ValueError('Application {}: only Generic applications have a parent'.format(appID))
+
+    return normalized
+
+
+def validateParents(entries):
+    """Check that the Generic apps are shown through a VNC or RTP app of the same file
+
+    Generic apps can not be parents, so removing a parent only takes its
+    direct children with it. An RTP parent has no display, so the app must
+    give one.
+    """
+    types = dict((entry['id'], entry['type']) for entry in entries)
+    for entry in entries:
+        if not 'parent' in entry:
+            continue
+        parentType = types.get(entry['parent'])
+        if parentType is None:
+            raise ValueError('Application {}: unknown parent {}'.format(entry['id'], entry['parent']))
+        if parentType == 'Generic':
+            raise ValueError('Application {}: parent {} is a Generic application, use its parent'.format(entry['id'], entry['parent']))
+        if parentType != 'VNC' and not 'display' in entry:
+            raise ValueError('Application {}: display is needed with {} parent {}'.format(entry['id'], parentType, entry['parent']))
+
+
+class ApplicationRegistry(object):
+    """Applications of a server described in a YAML or JSON file
+
+    The file has a list of applications, e.g.
+
+        applications:
+          - id: vnc
+            type: VNC
+            name: VNC
+            appCategory: "0xF0000001"
+            autoLaunch: true
+          - id: terminal
+            type: Generic
+            name: Terminal
+            command: [rxvt]
+            parent: vnc
+
+    The validated entries are stored in a pickle snapshot next to the file,
+    which is used instead of parsing the file as long as its mtime and size
+    are unchanged. When the file changes, only the changed entries are
+    updated in the server.
+    """
+
+    def __init__(self, server, host, path, watch=True):
+        self.server = server
+        self.host = host
+        self.path = path
+        self.snapshotPath = path + '.cache'
+
+        self.entries = {}	# Entry id -> validated entry
+        self.apps = {}	# Entry id -> Application
+
+        self.apply(self.load())
+
+        self.monitor = None
+        if watch:
+            from gi.repository import Gio
+            self.monitor = Gio.File.new_for_path(path).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            self.monitor.connect('changed', self.fileChanged)
+
+    def load(self):
+        """Return the list of validated entries, from the snapshot if it is up to date"""
+        import pickle
+
+        stat = os.stat(self.path)
+        key = (stat.st_mtime, stat.st_size)
+
+        try:
+            with open(self.snapshotPath, 'rb') as f:
+                snapshot = pickle.load(f)
+            if snapshot['key'] == key:
+                validateParents(snapshot['entries'])	# May be written by an older version
+                return snapshot['entries']
+        except (IOError, OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+            pass
+
+        with open(self.path) as f:
+            if self.path.endswith(('.yaml', '.yml')):
+                try:
+                    import yaml
+                except ImportError:
+                    raise ValueError('PyYAML is needed to read {}'.format(self.path))
+                try:
+                    data = yaml.safe_load(f)
+                except yaml.YAMLError as e:	# E.g. file is still being written
+                    raise ValueError('{}: {}'.format(self.path, e))
+            else:
+                import json
+                data = json.load(f)	# Errors are ValueErrors
+
+        # Wrong types anywhere in the file are reported like the other errors
+        try:
+            if not isinstance(data or {}, dict):
+                raise ValueError('{}: expected a mapping with applications'.format(self.path))
+            entries = [validateEntry(entry) for entry in (data or {}).get('applications') or []]
+        except (TypeError, AttributeError) as e:
+            raise ValueError('{}: {}'.format(self.path, e))
+        ids = [entry['id'] for entry in entries]
+        if len(set(ids)) != len(ids):
+            raise ValueError('Duplicate application ids in {}'.format(self.path))
+        validateParents(entries)
+
+        try:
+            with open(self.snapshotPath, 'wb') as f:
+                pickle.dump({'key': key, 'entries': entries}, f, 2)	# Readable by both Python 2 and 3
+        except (IOError, OSError) as e:
+            print('Could not write registry snapshot: {}'.format(e))
+
+        return entries
+
+    def create(self, entry):
+        cls = RegistryTypes[entry['type']]
+        if cls is GenericApplication:
+            app = GenericApplication(entry['command'], self.apps[entry['parent']], entry.get('display'))
+        else:
+            app = cls(self.host, self.server.pool)
+        if 'geometry' in entry:
+            app.geometry = entry['geometry']
+
+        for key in RegistryAttributes:
+            if key in entry:
+                setattr(app, key, entry[key])
+        return app
+
+    def apply(self, entries):
+        """Update the server to have the apps of the entries"""
+        newEntries = dict((entry['id'], entry) for entry in entries)
+
+        # Removed apps, and the ones that must be created again. Attributes
+        # can not be reset to the defaults in place, so removing one counts too.
+        removed = set()
+        for entryID, old in self.entries.items():
+            entry = newEntries.get(entryID)
+            if (entry is None or set(old) - set(entry) or
+                    any(entry.get(key) != old.get(key) for key in RegistryStructure)):
+                removed.add(entryID)
+
+        # Apps shown through a removed parent go with it, and their children too
+        cascade = True
+        while cascade:
+            cascade = False
+            for entryID, old in self.entries.items():
+                if old.get('parent') in removed and not entryID in removed:
+                    removed.add(entryID)
+                    cascade = True
+
+        # Children first, so no app is left with a parent that is gone
+        for entryID in sorted(removed, key=lambda entryID: self.entries[entryID].get('parent') is None):
+            self.server.removeApplication(self.apps.pop(entryID))
+            del self.entries[entryID]
+
+        # Parents are created before the apps shown through them
+        for entry in sorted(entries, key=lambda entry: entry['type'] == 'Generic'):
+            entryID = entry['id']
+            if not entryID in self.entries:
+                if entry.get('parent') is not None and not entry['parent'] in self.apps:
+                    print('Application {}: unknown parent {}'.format(entryID, entry['parent']))
+                    continue
+                self.apps[entryID] = self.create(entry)
+                self.server.addApplication(self.apps[entryID])
+            elif entry != self.entries[entryID]:
+                # Only listing attributes changed, listing is invalidated by the app
+                for key in RegistryAttributes:
+                    if key in entry and entry[key] != self.entries[entryID].get(key):
+                        setattr(self.apps[entryID], key, entry[key])
+            self.entries[entryID] = entry
+
+    def fileChanged(self, monitor, changedFile, otherFile, event):
+        from gi.repository import Gio
+
+        # Editors that replace the file only create it
+        if not event in (Gio.FileMonitorEvent.CHANGES_DONE_HINT, Gio.FileMonitorEvent.CREATED):
+            return
+
+        try:
+            entries = self.load()
+        except (IOError, OSError, ValueError) as e:
+            print('Not reloading applications, keeping the current ones: {}'.format(e))
+            return
+
+        print('Reloading applications from {}'.format(self.path))
+        self.apply(entries)
+
+
+def loadApplications(server, host, config=None):
+    """Add the applications of the registry file, or the default ones without it"""
+    if config:
+        return ApplicationRegistry(server, host, config)
+    return DefaultApplicationList(server, host)
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--interface', help='interface (address) to listen on', default='192.168.10.1')
+    parser.add_argument('-i', '--interface', help='interface (address) to listen on, can be given multiple times', action='append')
     parser.add_argument('-k', '--kill', help='Kill applications when application server quits', action='store_true')
+    parser.add_argument('-V', '--vnc-pool', help='Number of idle VNC servers to keep started in advance', default=0, type=int)
+    parser.add_argument('-c', '--config', help='Application registry file (YAML or JSON), default applications without it')
+    parser.add_argument('--cpu-budget', help='Total CPU budget of the applications (percent of one CPU), default 80 %% of all CPUs', type=int)
+    parser.add_argument('--memory-budget', help='Total memory budget of the applications (MB), default 75 %% of memory', type=int)
+    parser.add_argument('--cgroup', help='cgroup (v2) directory for the applications, empty to not use cgroups', default='/sys/fs/cgroup/tmlink')
     args = parser.parse_args()
 
-    interface = args.interface
+    interfaces = args.interface or ['192.168.10.1']
     kill = args.kill
 
     # This must be run before connecting to the bus (i.e. creating the server)
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-    server = ApplicationServer(interface)
-    appList = DefaultApplicationList(server, interface)
+    # Each interface is a separate session with its own applications
+    servers = []
+    appLists = []
+    limits = ResourceLimits(args.cpu_budget, args.memory_budget, args.cgroup)
+    for session, interface in enumerate(interfaces):
+        server = ApplicationServer(interface, session=session, vncPool=args.vnc_pool, limits=limits)
+        appLists.append(loadApplications(server, interface, args.config))
+        servers.append(server)
 
     # dbus_service = Session_DBus()
 
@@ -497,7 +1689,8 @@ def main():
         GLib.MainLoop().quit()
 
     if kill:
-        server.terminateAll()
+        for server in servers:
+            server.terminateAll(force=True)
 
 
 if __name__ == '__main__':
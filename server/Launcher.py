@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# Launcher - Starts the TM-Link servers when a host is connected
+# Copyright (C) 2019 Lauri Peltonen
+
+# Instead of running the servers (and the auto launched applications like
+# the VNC server) all the time, this waits for the USB link to come up,
+# optionally also for the first SSDP search from the host, and then starts
+# the application and UPnP servers. When the link has been down for the idle
+# time, the servers and their applications are stopped to free the memory.
+#
+# Only the standard library is used, so the launcher itself starts fast and
+# stays small while waiting.
+
+import argparse
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+# Netlink route groups and messages for following the interfaces
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+
+SSDP_ADDR = '239.255.255.250'
+SSDP_PORT = 1900
+
+
+def addressAssigned(address):
+    """Return True if the address belongs to a local interface"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.bind((address, 0))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def hasCarrier(link):
+    """Return True if the link is connected to the host"""
+    try:
+        with open('/sys/class/net/{}/carrier'.format(link)) as f:
+            return f.read().strip() == '1'
+    except OSError:	# Reading fails when the interface is down or missing
+        return False
+
+
+class Launcher:
+    def __init__(self, address, link, idle=60, onSearch=False, local=False, config=None, verbose=False):
+        self.address = address
+        self.link = link
+        self.idle = idle	# s, link must be down this long before the servers are stopped
+        self.onSearch = onSearch	# Wait for M-SEARCH from the host, not only the link
+        self.local = local
+        self.config = config
+        self.verbose = verbose
+
+        self.directory = os.path.dirname(os.path.abspath(__file__))
+        self.processes = []	# Running servers, (name, Popen)
+        self.downSince = None	# Time when the link went down
+
+        self.netlink = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.netlink.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+
+        self.ssdp = None	# Listening for the first search while waiting
+
+    def linkUp(self):
+        return hasCarrier(self.link) and addressAssigned(self.address)
+
+    def commands(self):
+        """Return list of (name, command) of the servers to start"""
+        upnp = ['python', os.path.join('upnp', 'UPnPServer.py'), '--interface={}'.format(self.address)]
+        appServer = ['python3', 'ApplicationServer.py', '--interface={}'.format(self.address), '--kill']
+        if self.config:
+            upnp.append('--config={}'.format(self.config))
+            appServer.append('--config={}'.format(self.config))
+
+        if self.local:
+            return [('UPnP server', upnp + ['--local', '--kill'])]
+        return [('Application server', appServer), ('UPnP server', upnp)]
+
+    def start(self):
+        started = time.time()
+        for name, command in self.commands():
+            print('Starting {}: {}'.format(name, ' '.join(command)))
+            # UPnP server quits when its stdin is closed
+            proc = subprocess.Popen(command, cwd=self.directory, stdin=subprocess.PIPE, preexec_fn=os.setsid)
+            self.processes.append((name, proc))
+        if self.verbose:
+            print('Servers started in {:.3f} s'.format(time.time() - started))
+
+    def stop(self, timeout=10):
+        # Ask nicely first, so that the servers terminate their applications
+        for name, proc in self.processes:
+            print('Stopping {}'.format(name))
+            proc.stdin.close()
+            proc.send_signal(signal.SIGINT)
+
+        deadline = time.time() + timeout
+        for name, proc in self.processes:
+            try:
+                proc.wait(max(0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                print('{} did not stop, killing it'.format(name))
+                os.killpg(os.getpgid(proc.pid), signal.SIGKILL)
+                proc.wait()
+
+        self.processes = []
+
+    def running(self):
+        # A crashed server is started again on the next trigger
+        for name, proc in self.processes:
+            if proc.poll() is not None:
+                print('{} exited with {}'.format(name, proc.returncode))
+                self.stop()
+                return False
+        return len(self.processes) > 0
+
+    def listenSearch(self):
+        """Listen to SSDP on the interface until the host searches for devices"""
+        if self.ssdp is not None:
+            return
+
+        self.ssdp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.ssdp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ssdp.bind(('', SSDP_PORT))
+        mreq = struct.pack('4s4s', socket.inet_aton(SSDP_ADDR), socket.inet_aton(self.address))
+        self.ssdp.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+    def closeSearch(self):
+        if self.ssdp is not None:
+            self.ssdp.close()
+            self.ssdp = None
+
+    def searched(self):
+        """Return True if a datagram waiting on the SSDP socket is M-SEARCH"""
+        data, addr = self.ssdp.recvfrom(4096)
+        if not data.startswith(b'M-SEARCH'):
+            return False
+
+        # The UPnP server starts a moment later, so the host will search again
+        if self.verbose:
+            print('Search from {}'.format(addr[0]))
+        return True
+
+    def run(self):
+        while True:
+            up = self.linkUp()
+            now = time.time()
+
+            if up:
+                self.downSince = None
+                if not self.running():
+                    if self.onSearch:
+                        self.listenSearch()
+                    else:
+                        self.start()
+            else:
+                self.closeSearch()
+                if self.downSince is None:
+                    self.downSince = now
+                    if self.processes:
+                        print('Link down, stopping servers in {} s'.format(self.idle))
+                if self.processes and now - self.downSince >= self.idle:
+                    self.stop()
+
+            # Wait for link changes, the search, or the idle time to pass
+            timeout = None
+            if self.processes:
+                timeout = 5	# Also follow if the servers exit by themselves
+                if self.downSince is not None:
+                    timeout = max(0, min(timeout, self.downSince + self.idle - now))
+
+            sockets = [self.netlink] + ([self.ssdp] if self.ssdp is not None else [])
+            readable, _, _ = select.select(sockets, [], [], timeout)
+
+            if self.netlink in readable:
+                self.netlink.recv(65536)	# Contents do not matter, the state is read again
+            if self.ssdp in readable and self.searched():
+                self.closeSearch()
+                self.start()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--interface', help='interface (address) to serve', default='192.168.10.1')
+    parser.add_argument('-n', '--link', help='network interface the host connects to', default='usb0')
+    parser.add_argument('-t', '--idle', help='Stop the servers after the link has been down this long (s)', default=60, type=int)
+    parser.add_argument('-s', '--on-search', help='Start the servers only when the host searches for devices', action='store_true')
+    parser.add_argument('-l', '--local', help='Run the application server inside the UPnP server', action='store_true')
+    parser.add_argument('-c', '--config', help='Application registry file (YAML or JSON)')
+    parser.add_argument('-v', '--verbose', help='Verbose output', action='store_true')
+    args = parser.parse_args()
+
+    launcher = Launcher(args.interface, args.link, args.idle, args.on_search, args.local, args.config, args.verbose)
+    try:
+        launcher.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        launcher.stop()
+
+
+if __name__ == '__main__':
+    main()
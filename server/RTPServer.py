@@ -12,6 +12,22 @@ import select
 import subprocess
 
 import sys
+import time
+
+# Python RTP packetizer
+import struct
+import random
+import ctypes
+import ctypes.util
+
+# GStreamer bindings are used to stream in-process, if they are not
+# available gst-launch-1.0 is used instead
+try:
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import Gst, GLib
+except (ImportError, ValueError):
+    Gst = None
 
 
 PAYLOADS = {
@@ -25,16 +41,346 @@ RESAMPLE = {
 #RTP_COMMAND = 'gst-launch-1.0 -v alsasrc device=hw:1,1,0 ! decodebin ! audioresample ! \'audio/x-raw, rate=48000' ! audioconvert ! 'audio/x-raw, layout=(string)interleaved, media=(string)audio, clock-rate=(int)48000, encoding-name=(string)L16, encoding-params=(string)2, channels=(int)2, payload=(int)0\' ! rtpL16pay  ! udpsink host={} port={}'
 # Client command: gst-launch-1.0 -v updsrc port={} caps=\"application/x-rtp, media=(string)audio, format=(string)S32LE, layout=(string)interleaved, clock-rate=(int)48000, channels=(int)2, payload=(int)0\" ! rtpL16depay ! playsink'
 
+
+class RTPStream():
+    """In-process GStreamer pipeline streaming the ALSA device over RTP
+
+    The pipeline is built and the device opened already when the stream is
+    created, so that start only needs to set the destination and play.
+    The audio is captured and packetized once and sent to all the clients.
+    """
+
+    def __init__(self, device, type=99, stream_port=0):
+        self.device = device
+        self.type = type
+        self.clients = set()	# (host, port) tuples
+
+        Gst.init(None)
+
+        desc = 'alsasrc device={} ! decodebin ! audioresample ! {} ! audioconvert ! {} ! rtpL16pay name=pay pt={} ! multiudpsink name=sink'.format(
+            device, RESAMPLE[type], PAYLOADS[type], type)
+        if stream_port != 0:
+            desc += ' bind-port={}'.format(stream_port)
+
+        self.pipeline = Gst.parse_launch(desc)
+        self.payloader = self.pipeline.get_by_name('pay')
+        self.sink = self.pipeline.get_by_name('sink')
+
+        self.pipeline.set_state(Gst.State.READY)
+
+    def addClient(self, host, port):
+        """Add destination, streaming starts with the first one"""
+        if (host, port) in self.clients:
+            return
+
+        self.clients.add((host, port))
+        self.sink.emit('add', host, port)
+        if len(self.clients) == 1:
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def removeClient(self, host, port):
+        """Remove destination, capture is stopped when there are none left"""
+        if not (host, port) in self.clients:
+            return
+
+        self.clients.discard((host, port))
+        self.sink.emit('remove', host, port)
+        if not self.clients:
+            self.pipeline.set_state(Gst.State.READY)
+
+    def start(self, host, port):
+        """Start streaming to host:port only"""
+        self.retarget(host, port)
+
+    def retarget(self, host, port):
+        """Replace all the destinations with host:port, can be called while streaming"""
+        for client in list(self.clients):
+            if client != (host, port):
+                self.removeClient(*client)
+        self.addClient(host, port)
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+        self.sink.emit('clear')
+        self.clients = set()
+
+    def stats(self):
+        """Return dictionary of stream statistics"""
+        stats = {
+            'clients': sorted(self.clients),
+            'state': Gst.Element.state_get_name(self.pipeline.get_state(0)[1]),
+            'bytes': self.sink.get_property('bytes-served'),
+            }
+
+        payStats = self.payloader.get_property('stats')
+        if payStats:
+            stats['seqnum'] = payStats.get_value('seqnum')
+            stats['timestamp'] = payStats.get_value('timestamp')
+
+        return stats
+
+
+# sendmmsg(2) structures, to send a batch of packets with one system call
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+    _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                ('sin_addr', ctypes.c_uint8 * 4), ('sin_zero', ctypes.c_uint8 * 8)]
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    sendmmsg = libc.sendmmsg
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+    sendmmsg = None	# Packets are sent one by one
+
+
+class RTPPacketizer():
+    """Packetize raw L16 audio into RTP packets and send them to the clients
+
+    The packets are built in a preallocated ring of buffers. Only the
+    sequence number and timestamp of the 12 byte header are patched for
+    each packet and the payload is copied once from the captured audio.
+    Packets of one push are sent to all the clients with one sendmmsg call.
+
+    push is called from the GStreamer streaming thread while the clients
+    change in the main loop, so the clients are given to push as an
+    immutable snapshot which is replaced, never modified.
+    """
+
+    def __init__(self, sock, type=99, payloadSize=1152, frameSize=4, ringSize=16):
+        self.sock = sock
+        self.type = type
+        self.payloadSize = payloadSize - payloadSize % frameSize	# Only full frames in a packet
+        self.frameSize = frameSize	# Bytes per sample of all channels
+        self.ringSize = ringSize
+
+        self.seq = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.ssrc = random.getrandbits(32)
+
+        self.ring = [bytearray(12 + self.payloadSize) for n in range(ringSize)]
+        self.views = [memoryview(buf) for buf in self.ring]
+        for buf in self.ring:
+            struct.pack_into('!BBI', buf, 0, 0x80, type, 0)	# Version 2, payload type
+            struct.pack_into('!I', buf, 8, self.ssrc)
+
+        self.current = 0	# Ring buffer being filled
+        self.fill = 0	# Payload bytes in the current buffer
+        self.pending = 0	# Completed packets not yet sent
+
+        self.clients = {}	# (host, port) -> sockaddr_in, only used in the main loop
+        self.iovecs = (iovec * ringSize)()
+        self.cbuffers = [(ctypes.c_char * len(buf)).from_buffer(buf) for buf in self.ring]
+        for n, cbuf in enumerate(self.cbuffers):
+            self.iovecs[n].iov_base = ctypes.addressof(cbuf)
+
+        # (((host, port), sockaddr_in) tuple, mmsghdr array) read by flush. The
+        # addresses are kept with the messages that point to them.
+        self.snapshot = ((), None)
+
+        self.packets = 0
+        self.bytes = 0
+        self.calls = 0
+
+    def addClient(self, host, port):
+        addr = sockaddr_in(socket.AF_INET, socket.htons(port))
+        addr.sin_addr[:] = bytearray(socket.inet_aton(host))
+        self.clients[(host, port)] = addr
+        self.buildMessages()
+
+    def removeClient(self, host, port):
+        self.clients.pop((host, port), None)
+        self.buildMessages()
+
+    def buildMessages(self):
+        """Build one message per ring buffer and client, and publish them to flush"""
+        clients = tuple(self.clients.items())
+        messages = None
+        if sendmmsg is not None:
+            messages = self.buildBatch(clients)
+        self.snapshot = (clients, messages)	# Atomic, flush sees old or new one
+
+    def buildBatch(self, clients):
+        messages = (mmsghdr * (self.ringSize * len(clients)))()
+        n = 0
+        for key, addr in clients:
+            for i in range(self.ringSize):
+                hdr = messages[n].msg_hdr
+                hdr.msg_name = ctypes.addressof(addr)
+                hdr.msg_namelen = ctypes.sizeof(addr)
+                hdr.msg_iov = ctypes.pointer(self.iovecs[i])
+                hdr.msg_iovlen = 1
+                n += 1
+        return messages
+
+    def push(self, data):
+        """Packetize and send the audio data (bytes-like)"""
+        data = memoryview(data)
+        pos = 0
+        while pos < len(data):
+            count = min(self.payloadSize - self.fill, len(data) - pos)
+            start = 12 + self.fill
+            self.views[self.current][start:start + count] = data[pos:pos + count]
+            self.fill += count
+            pos += count
+
+            if self.fill == self.payloadSize:
+                self.complete()
+
+        self.flush()
+
+    def complete(self):
+        """Finish the current packet header and move to the next buffer"""
+        struct.pack_into('!HI', self.ring[self.current], 2, self.seq, self.timestamp)
+        self.iovecs[self.current].iov_len = 12 + self.fill
+
+        self.seq = (self.seq + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + self.fill // self.frameSize) & 0xFFFFFFFF
+
+        self.fill = 0
+        self.pending += 1
+        self.current = (self.current + 1) % self.ringSize
+        if self.pending == self.ringSize:	# Ring is full
+            self.flush()
+
+    def flush(self):
+        """Send the completed packets to all the clients"""
+        clients, messages = self.snapshot	# Read once, may be replaced meanwhile
+        if not self.pending or not clients:
+            self.pending = 0
+            return
+
+        first = (self.current - self.pending) % self.ringSize
+        indices = [(first + n) % self.ringSize for n in range(self.pending)]
+
+        if messages is not None:
+            # Messages of each client are laid out in ring order, collect the
+            # pending ones to the start of a contiguous batch
+            batch = (mmsghdr * (self.pending * len(clients)))()
+            n = 0
+            for c in range(len(clients)):
+                for i in indices:
+                    batch[n] = messages[c * self.ringSize + i]
+                    n += 1
+
+            sent = 0
+            while sent < n:
+                ret = sendmmsg(self.sock.fileno(), ctypes.addressof(batch) + sent * ctypes.sizeof(mmsghdr), n - sent, 0)
+                self.calls += 1
+                if ret <= 0:
+                    break	# Send buffer full or error, drop the rest
+                sent += ret
+        else:
+            for addr, sockaddr in clients:
+                for i in indices:
+                    self.sock.sendto(self.views[i][:self.iovecs[i].iov_len], addr)
+                    self.calls += 1
+
+        self.packets += self.pending
+        self.bytes += sum(self.iovecs[i].iov_len for i in indices)
+        self.pending = 0
+
+    def stats(self):
+        return {'packets': self.packets, 'bytes': self.bytes, 'calls': self.calls}
+
+
+class RTPPacketizerStream(RTPStream):
+    """Stream where the RTP packets are built with RTPPacketizer instead of GStreamer"""
+
+    def __init__(self, device, type=99, stream_port=0, payloadSize=1152):
+        self.device = device
+        self.type = type
+        self.clients = set()
+
+        Gst.init(None)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if stream_port != 0:
+            self.sock.bind(('', stream_port))
+        self.sock.setblocking(0)
+        self.packetizer = RTPPacketizer(self.sock, type, payloadSize)
+
+        # L16 payload is big endian
+        desc = 'alsasrc device={} ! decodebin ! audioresample ! {} ! audioconvert ! audio/x-raw, format=S16BE, layout=interleaved, channels=2 ! appsink name=sink emit-signals=true sync=false'.format(
+            device, RESAMPLE[type])
+
+        self.pipeline = Gst.parse_launch(desc)
+        self.sink = self.pipeline.get_by_name('sink')
+        self.sink.connect('new-sample', self.newSample)
+
+        self.pipeline.set_state(Gst.State.READY)
+
+    def newSample(self, sink):
+        sample = sink.emit('pull-sample')
+        buf = sample.get_buffer()
+        ok, info = buf.map(Gst.MapFlags.READ)
+        if ok:
+            self.packetizer.push(info.data)
+            buf.unmap(info)
+        return Gst.FlowReturn.OK
+
+    def addClient(self, host, port):
+        if (host, port) in self.clients:
+            return
+
+        self.clients.add((host, port))
+        self.packetizer.addClient(host, port)
+        if len(self.clients) == 1:
+            self.pipeline.set_state(Gst.State.PLAYING)
+
+    def removeClient(self, host, port):
+        if not (host, port) in self.clients:
+            return
+
+        self.clients.discard((host, port))
+        self.packetizer.removeClient(host, port)
+        if not self.clients:
+            self.pipeline.set_state(Gst.State.READY)
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+        for client in list(self.clients):
+            self.packetizer.removeClient(*client)
+        self.clients = set()
+
+    def stats(self):
+        stats = {
+            'clients': sorted(self.clients),
+            'state': Gst.Element.state_get_name(self.pipeline.get_state(0)[1]),
+            }
+        stats.update(self.packetizer.stats())
+        return stats
+
+
 class RTPServer():
     """Server that handles launching the RTP stream on client address"""
 
-    def __init__(self, interface, port=0, device='hw:1,1,0'):
+    def __init__(self, interface, port=0, device='hw:1,1,0', expire=0, payloadSize=0):
         self.interface = interface
         self.port = port
         self.socket = None
         self.proc = None
         self.device = device
 
+        self.stream = None
+        self.subscribers = {}	# (host, port) -> time of the last byte received
+        self.expire = expire	# Seconds without bytes before client is dropped, 0 = never
+        self.payloadSize = payloadSize	# If set, packetize in Python with this payload size
+        self.loop = None
+        self.returnCode = 0
+
     def launch(self):
         """Launch the listening server, return the stream address"""
 
@@ -59,37 +405,116 @@ class RTPServer():
             print('Unknown payload (stream) type: {}'.format(type))
             return -1
 
-        print uri
-        if self.socket and not self.clientAddress:
-            readable, writable, exceptional = select.select([self.socket], [], [], timeout)
-
-            if self.socket in readable:
-                if verbose:
-                    print 'Byte received from client'
-
-                # Data received, read the byte and discard
-                data, addr = self.socket.recvfrom(1)
-
-                self.clientAddress = addr[0]
-                self.clientPort = addr[1]
-                print addr, self.clientAddress, self.clientPort
-
-                # Close the socket
-                self.socket.close()
-
-                #RTP_COMMAND = 'gst-launch-1.0 -v alsasrc device=hw:1,1,0 ! decodebin ! audioresample ! \'audio/x-raw, rate=48000' ! audioconvert ! 'audio/x-raw, layout=(string)interleaved, media=(string)audio, clock-rate=(int)48000, encoding-name=(string)L16, encoding-params=(string)2, channels=(int)2, payload=(int)0\' ! rtpL16pay  ! udpsink host={} port={}'
-                cmd = ['gst-launch-1.0']
-                if verbose:
-                    cmd.append('-v')
-                cmd.extend(['alsasrc', 'device={}'.format(self.device), '!', 'decodebin', '!', 'audioresample', '!', RESAMPLE[type], '!', 'audioconvert', '!', PAYLOADS[type], '!', 'rtpL16pay', 'pt=99', '!', 'udpsink', 'host={}'.format(self.clientAddress), 'port={}'.format(self.clientPort)])
-                if stream_port != 0:
-                    cmd.append('bind-port={}'.format(stream_port))
+        print(uri)
+        if not self.socket:
+            return -1
 
-                # Launch the streaming server
-                # TODO: Should not use shell, instead use some smarter way to handle the arguments?
-                # self.proc = subprocess.Popen(RTP_COMMAND.format(self.clientAddress, self.clientPort), preexec_fn=os.setsid, shell=True)
-                #self.proc = subprocess.Popen(['gst-launch-1.0', '-v', 'filesrc', 'location=./test.mp3', '!', 'decodebin', '!', 'audioresample', '!', RESAMPLE[payloadType], '!', 'audioconvert', '!', PAYLOADS[payloadType], '!', 'rtpL16pay', 'pt={}'.format(payloadType), '!', 'udpsink', 'host={}'.format(self.clientAddress), 'port={}'.format(clientPort)])
-                return subprocess.call(cmd)	# Blocking call
+        if Gst is None:
+            return self.runCommand(type, timeout, stream_port, verbose)
+
+        # Build the pipeline while waiting for the client
+        if self.payloadSize:
+            self.stream = RTPPacketizerStream(self.device, type, stream_port, self.payloadSize)
+        else:
+            self.stream = RTPStream(self.device, type, stream_port)
+        self.verbose = verbose
+        self.loop = GLib.MainLoop()
+
+        bus = self.stream.pipeline.get_bus()
+        bus.add_signal_watch()
+        bus.connect('message::error', self.streamError)
+        bus.connect('message::eos', self.streamEnd)
+
+        # Keep listening, clients send keep-alive bytes and more clients may subscribe
+        GLib.io_add_watch(self.socket.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self.clientPacket)
+        GLib.timeout_add_seconds(timeout, self.connectTimeout)
+        if self.expire:
+            GLib.timeout_add_seconds(max(1, self.expire // 2), self.expireClients)
+        if verbose:
+            GLib.timeout_add_seconds(10, self.printStats)
+
+        try:
+            self.loop.run()
+        except KeyboardInterrupt:
+            pass
+
+        self.stream.stop()
+        self.socket.close()
+        return self.returnCode
+
+    def clientPacket(self, fd, condition):
+        """Byte received from client, subscribe it or refresh its subscription"""
+        try:
+            data, addr = self.socket.recvfrom(1)
+        except socket.error:
+            return True
+
+        if not addr in self.subscribers:
+            print('Streaming to {}:{}'.format(addr[0], addr[1]))
+            self.stream.addClient(addr[0], addr[1])
+
+        self.subscribers[addr] = time.time()
+        self.clientAddress = addr[0]
+        self.clientPort = addr[1]
+
+        return True
+
+    def expireClients(self):
+        """Drop the clients that have not sent keep-alive bytes"""
+        limit = time.time() - self.expire
+        for addr in [a for a in self.subscribers if self.subscribers[a] < limit]:
+            print('Client {}:{} expired'.format(addr[0], addr[1]))
+            del self.subscribers[addr]
+            self.stream.removeClient(addr[0], addr[1])
+        return True
+
+    def connectTimeout(self):
+        if not self.clientAddress:
+            print('Timeout waiting for connection')
+            self.returnCode = -1
+            self.loop.quit()
+        return False
+
+    def printStats(self):
+        print(self.stream.stats())
+        return True
+
+    def streamError(self, bus, message):
+        err, debug = message.parse_error()
+        print('Stream error: {}'.format(err))
+        self.returnCode = -1
+        self.loop.quit()
+
+    def streamEnd(self, bus, message):
+        self.loop.quit()
+
+    def runCommand(self, type, timeout, stream_port, verbose):
+        """Stream with gst-launch-1.0, used if GStreamer bindings are not available"""
+        readable, writable, exceptional = select.select([self.socket], [], [], timeout)
+
+        if self.socket in readable:
+            if verbose:
+                print('Byte received from client')
+
+            # Data received, read the byte and discard
+            data, addr = self.socket.recvfrom(1)
+
+            self.clientAddress = addr[0]
+            self.clientPort = addr[1]
+            print('{} {} {}'.format(addr, self.clientAddress, self.clientPort))
+
+            # Close the socket
+            self.socket.close()
+
+            cmd = ['gst-launch-1.0']
+            if verbose:
+                cmd.append('-v')
+            cmd.extend(['alsasrc', 'device={}'.format(self.device), '!', 'decodebin', '!', 'audioresample', '!', RESAMPLE[type], '!', 'audioconvert', '!', PAYLOADS[type], '!', 'rtpL16pay', 'pt=99', '!', 'udpsink', 'host={}'.format(self.clientAddress), 'port={}'.format(self.clientPort)])
+            if stream_port != 0:
+                cmd.append('bind-port={}'.format(stream_port))
+
+            # Launch the streaming server
+            return subprocess.call(cmd)	# Blocking call
 
         print('Timeout waiting for connection')
         return -1
@@ -106,6 +531,8 @@ def main():
     parser.add_argument('-T', '--timeout', help='Timeout waiting for connection (s)', default=60, type=int)
     parser.add_argument('-d', '--device', help='ALSA sound device to use', default='hw:1,1,0')
     parser.add_argument('-t', '--type', help='Stream (RTP payload) type', default=99, type=int, choices=supportedPayloads)
+    parser.add_argument('-e', '--expire', help='Drop clients that do not send keep-alive bytes in this time (s), 0 = never', default=0, type=int)
+    parser.add_argument('-s', '--payload-size', help='Packetize in Python with this payload size (bytes) instead of rtpL16pay, 0 = use rtpL16pay', default=0, type=int)
     parser.add_argument('-v', '--verbose', help='Verbose output', action='store_true')
     args = parser.parse_args()
 
@@ -117,12 +544,10 @@ def main():
     type=args.type
     verbose=args.verbose
 
-    rtpServer = RTPServer(interface, port, device)
+    rtpServer = RTPServer(interface, port, device, args.expire, args.payload_size)
     uri = rtpServer.launch()
     rtpServer.run(uri, type, timeout, stream_port, verbose)
 
 
 if __name__ == '__main__':
     main()
-
-
@@ -0,0 +1,12 @@
+# TmSession - Names shared by the application server and the UPnP server
+# Copyright (C) 2019 Lauri Peltonen
+
+# Imported by both ApplicationServer (Python 3) and the UPnP server
+# (Python 2), so this must stay compatible with both and import nothing heavy.
+
+
+def sessionPath(session):
+    """D-BUS object path of the application server of a session (interface)"""
+    if session == 0:
+        return '/org/tmlink'
+    return '/org/tmlink/{}'.format(session)
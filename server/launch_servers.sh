@@ -4,3 +4,9 @@
 
 python3 ApplicationServer.py --interface=192.168.10.1 --kill &
 python upnp/UPnPServer.py --interface=192.168.10.1
+
+# Alternatively run both in a single process, without D-BUS in between
+#python upnp/UPnPServer.py --interface=192.168.10.1 --local --kill
+
+# Or start them only when a host is connected, and stop after it is unplugged
+#python3 Launcher.py --interface=192.168.10.1 --link=usb0 --idle=60
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+# compare_modes - Memory and action latency of the separate and local server modes
+# Copyright (C) 2019 Lauri Peltonen
+
+# Starts the servers in each mode in turn, the same way as launch_servers.sh:
+#   separate: ApplicationServer.py and upnp/UPnPServer.py talking over D-BUS
+#   local:    upnp/UPnPServer.py --local, the application server in-process
+# and reports the time until the device answers discovery and actions, the
+# latency of the actions and the RSS of the server processes. Run on the
+# device with the interface up and no other servers running, e.g.
+#   python3 tools/compare_modes.py --interface 192.168.10.1 --rounds 100
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def commands(mode, interface):
+    upnp = ['python', os.path.join('upnp', 'UPnPServer.py'), '--interface={}'.format(interface)]
+    if mode == 'local':
+        return [upnp + ['--local', '--kill']]
+    return [['python3', 'ApplicationServer.py', '--interface={}'.format(interface), '--kill'], upnp]
+
+
+def rss(pid):
+    """Resident memory of the process in kB"""
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def waitFor(call, timeout):
+    """Call until it does not raise, returns its result or None after the timeout"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            return call()
+        except Exception:
+            time.sleep(0.1)
+    return None
+
+
+def measure(mode, interface, rounds, timeout):
+    started = time.perf_counter()
+    procs = [subprocess.Popen(command, cwd=SERVER_DIR, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                              preexec_fn=os.setsid) for command in commands(mode, interface)]
+    try:
+        location = None
+        while location is None and time.perf_counter() - started < timeout:
+            location, took = tmclient.search(1, interface)
+        if location is None:
+            print('{}: no answer to discovery'.format(mode))
+            return
+        discovered = time.perf_counter() - started
+
+        server = waitFor(lambda: tmclient.ApplicationServer(location), timeout)
+        apps = waitFor(server.applications, timeout) if server else None
+        if not apps:
+            print('{}: application server did not answer'.format(mode))
+            return
+        ready = time.perf_counter() - started
+
+        appID = sorted(apps.values())[0]
+        results = {}
+        for action, arguments in [
+                ('GetApplicationList', {'AppListingFilter': '', 'ProfileID': 0}),
+                ('GetApplicationList', {'AppListingFilter': 'protocolID="VNC"', 'ProfileID': 0}),
+                ('GetApplicationStatus', {'AppID': appID})]:
+            name = action + (' (filtered)' if arguments.get('AppListingFilter') else '')
+            latencies = []
+            for n in range(rounds):
+                callStarted = time.perf_counter()
+                server.call(action, **arguments)
+                latencies.append(time.perf_counter() - callStarted)
+            results[name] = latencies
+
+        memory = sum(rss(proc.pid) for proc in procs)
+
+        print('{}: discovery after {:.2f} s, actions after {:.2f} s, RSS {:.1f} MB in {} process(es)'.format(
+            mode, discovered, ready, memory / 1024.0, len(procs)))
+        for name in sorted(results):
+            print('  {:32} p50 {:6.1f} ms  p95 {:6.1f} ms'.format(
+                name, tmclient.percentile(results[name], 50) * 1000, tmclient.percentile(results[name], 95) * 1000))
+    finally:
+        # Like the launcher, UPnP server quits when its stdin is closed
+        for proc in procs:
+            proc.stdin.close()
+            proc.send_signal(signal.SIGINT)
+        for proc in procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the separate and local server modes')
+    parser.add_argument('-i', '--interface', help='Interface (address) to serve', default='192.168.10.1')
+    parser.add_argument('-n', '--rounds', help='Calls of each action', default=100, type=int)
+    parser.add_argument('-t', '--timeout', help='Time to wait for the servers to start (s)', default=60, type=float)
+    parser.add_argument('-m', '--mode', help='Measure only one mode', choices=['separate', 'local'])
+    args = parser.parse_args()
+
+    for mode in [args.mode] if args.mode else ['separate', 'local']:
+        measure(mode, args.interface, args.rounds, args.timeout)
+        time.sleep(2)	# Let the ports and the bus name be released
+
+
+if __name__ == '__main__':
+    main()
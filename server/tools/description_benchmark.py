@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+# description_benchmark - Fetches per second of the device and service descriptions
+# Copyright (C) 2019 Lauri Peltonen
+
+# Fetches the device description and the SCPD of each service of a running
+# server for a while, first plainly and then with If-None-Match of the ETag
+# the server returned, as a client re-fetching them after reconnecting does.
+#   python3 tools/description_benchmark.py --interface 192.168.10.1 --seconds 5
+
+import argparse
+import http.client
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+
+def documents(location):
+    """Return the URLs of the device description and the service descriptions"""
+    status, headers, body = tmclient.request(location)
+    root = ET.fromstring(body)
+    base = root.findtext(tmclient.DEVICE_NS + 'URLBase') or location
+    return [location] + [urljoin(base, service.findtext(tmclient.DEVICE_NS + 'SCPDURL'))
+                         for service in root.iter(tmclient.DEVICE_NS + 'service')]
+
+
+def fetch(url, seconds, headers, keepAlive):
+    """Fetch the URL repeatedly, returns (fetches, elapsed seconds, statuses, body bytes)"""
+    part = urlparse(url)
+    conn = None
+    fetches = 0
+    statuses = {}
+    received = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        if conn is None:
+            conn = http.client.HTTPConnection(part.hostname, part.port or 80, timeout=10)
+        conn.request('GET', part.path or '/', None, headers)
+        response = conn.getresponse()
+        received += len(response.read())
+        statuses[response.status] = statuses.get(response.status, 0) + 1
+        fetches += 1
+        if not keepAlive or response.getheader('Connection', '').lower() == 'close':
+            conn.close()
+            conn = None
+    elapsed = time.perf_counter() - started
+    if conn is not None:
+        conn.close()
+    return fetches, elapsed, statuses, received
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the description fetches')
+    parser.add_argument('-l', '--location', help='Device description URL, searched for if not given')
+    parser.add_argument('-i', '--interface', help='Interface (address) to search through')
+    parser.add_argument('-s', '--seconds', help='Seconds to fetch each document in each mode', default=5, type=float)
+    parser.add_argument('-k', '--keep-alive', help='Reuse the connection instead of connecting for every fetch', action='store_true')
+    args = parser.parse_args()
+
+    location = args.location
+    if location is None:
+        location, took = tmclient.search(5, args.interface)
+        if location is None:
+            sys.exit('No TM-Link server found')
+
+    print('{:40} {:>12} {:>10} {:>10} {:>12}'.format('document', 'mode', 'fetches/s', 'ms/fetch', 'bytes/fetch'))
+    for url in documents(location):
+        status, headers, body = tmclient.request(url)
+        etag = headers.get('ETAG')
+        modes = [('plain', {})]
+        if etag:
+            modes.append(('conditional', {'If-None-Match': etag}))
+        else:
+            print('{}: no ETag, conditional fetches not measured'.format(url))
+
+        for mode, requestHeaders in modes:
+            fetches, elapsed, statuses, received = fetch(url, args.seconds, requestHeaders, args.keep_alive)
+            expected = 304 if requestHeaders else 200
+            if statuses.get(expected, 0) != fetches:
+                print('{}: unexpected statuses {}'.format(url, statuses))
+            print('{:40} {:>12} {:10.0f} {:10.2f} {:12.0f}'.format(
+                urlparse(url).path[-40:], mode, fetches / elapsed, elapsed / fetches * 1000, received / float(fetches)))
+
+
+if __name__ == '__main__':
+    main()
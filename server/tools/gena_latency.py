@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+# gena_latency - Delay from an application exit to the AppStatusUpdate event
+# Copyright (C) 2019 Lauri Peltonen
+
+# Subscribes to the TmApplicationServer events with a local GENA callback
+# server, launches the application and stops it again, and measures the time
+# until the NOTIFY with the app in AppStatusUpdate arrives. The event
+# window of the application server (50 ms) is included in the delay.
+#
+# With --kill the process of the app is killed directly, which must be done
+# on the device, e.g.
+#   python3 tools/gena_latency.py --app Terminal --kill rxvt
+# Without it the app is stopped with TerminateApplication from the client,
+# and the delay also includes the round trip of that action.
+
+import argparse
+import http.server
+import os
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+
+class EventReceiver(http.server.HTTPServer):
+    """GENA callback server collecting (time, SEQ, {variable: value})"""
+
+    def __init__(self, address):
+        http.server.HTTPServer.__init__(self, address, EventHandler)
+        self.events = []
+        self.received = threading.Condition()
+
+    def mark(self):
+        """Return the position to wait for the events after"""
+        with self.received:
+            return len(self.events)
+
+    def waitFor(self, check, since, timeout):
+        """Return the time of the first event after since for which check(variables) is true"""
+        deadline = time.perf_counter() + timeout
+        with self.received:
+            seen = since
+            while True:
+                for when, seq, variables in self.events[seen:]:
+                    if check(variables):
+                        return when
+                seen = len(self.events)
+                left = deadline - time.perf_counter()
+                if left <= 0:
+                    return None
+                self.received.wait(left)
+
+
+class EventHandler(http.server.BaseHTTPRequestHandler):
+    def do_NOTIFY(self):
+        when = time.perf_counter()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        variables = {}
+        for prop in ET.fromstring(body):
+            for variable in prop:
+                variables[variable.tag.split('}')[-1]] = variable.text or ''
+
+        self.send_response(200)
+        self.end_headers()
+        with self.server.received:
+            self.server.events.append((when, self.headers.get('SEQ'), variables))
+            self.server.received.notify_all()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def containsApp(appID):
+    def check(variables):
+        return appID in variables.get('AppStatusUpdate', '').split(',')
+    return check
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure application status event latency')
+    parser.add_argument('-l', '--location', help='Device description URL, searched if not given')
+    parser.add_argument('-a', '--app', help='Name of the application to launch', required=True)
+    parser.add_argument('-k', '--kill', help='Kill the processes matching this pattern (pkill -f) instead of TerminateApplication')
+    parser.add_argument('-n', '--rounds', help='Number of launch / exit rounds', default=5, type=int)
+    parser.add_argument('-t', '--timeout', help='Time to wait for each event (s)', default=5, type=float)
+    args = parser.parse_args()
+
+    server = tmclient.findServer(args.location)
+    appID = server.applications().get(args.app)
+    if appID is None:
+        print('No application named {}'.format(args.app))
+        return 1
+
+    receiver = EventReceiver((tmclient.localAddress(server.eventURL), 0))
+    threading.Thread(target=receiver.serve_forever, daemon=True).start()
+    callback = 'http://{}:{}/'.format(*receiver.server_address)
+    sid = server.subscribe(callback)
+
+    delays = []
+    try:
+        for n in range(args.rounds):
+            mark = receiver.mark()
+            server.call('LaunchApplication', AppID=appID, ProfileID=0)
+            if receiver.waitFor(containsApp(appID), mark, args.timeout) is None:
+                print('No event for the launch')
+            time.sleep(1)	# Let the app start up
+
+            mark = receiver.mark()
+            started = time.perf_counter()
+            if args.kill:
+                subprocess.call(['pkill', '-f', args.kill])
+            else:
+                server.call('TerminateApplication', AppID=appID, ProfileID=0)
+            received = receiver.waitFor(containsApp(appID), mark, args.timeout)
+
+            if received is None:
+                print('{}: no event in {} s'.format(n, args.timeout))
+            else:
+                delays.append(received - started)
+                print('{}: {:.1f} ms'.format(n, delays[-1] * 1000))
+    finally:
+        server.unsubscribe(sid)
+        receiver.shutdown()
+
+    if delays:
+        print('median {:.1f} ms, max {:.1f} ms'.format(tmclient.percentile(delays, 50) * 1000, max(delays) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
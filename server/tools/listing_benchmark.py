@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+# listing_benchmark - Application listing calls per second, cached and rebuilt
+# Copyright (C) 2019 Lauri Peltonen
+
+# Runs the ApplicationServer in this process (without D-BUS) with a number
+# of synthetic applications and calls the listing like GetApplicationList
+# does. "rebuilt" drops the cached listing before every call, which is what
+# every call cost before the listing was cached.
+#
+# Needs the same modules as ApplicationServer.py (lxml, dbus, gi), e.g.
+#   python3 tools/listing_benchmark.py --apps 20 --seconds 3
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import ApplicationServer
+
+
+def rate(call, seconds):
+    """Return calls per second of call() over the given time"""
+    count = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        call()
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the application listing')
+    parser.add_argument('-a', '--apps', help='Number of applications', default=20, type=int)
+    parser.add_argument('-s', '--seconds', help='Time to run each case (s)', default=3, type=float)
+    parser.add_argument('-f', '--filter', help='Filter to use in the filtered cases', default='protocolID="VNC"')
+    args = parser.parse_args()
+
+    server = ApplicationServer.ApplicationServer('127.0.0.1', bus=False,
+                                                 limits=ApplicationServer.ResourceLimits(root=None))
+    for n in range(args.apps):
+        app = ApplicationServer.Application('127.0.0.1')
+        app.name = 'Application {}'.format(n)
+        app.protocolID = 'VNC' if n % 2 else 'RTP'
+        server.addApplication(app)
+
+    def rebuilt(filterString=''):
+        server.xmlString = None
+        server.filterCache = {}
+        server.index = None
+        server.listing(filterString, 0)
+
+    cases = [
+        ('full, rebuilt', lambda: rebuilt()),
+        ('full, cached', lambda: server.listing('', 0)),
+        ('filtered, rebuilt', lambda: rebuilt(args.filter)),
+        ('filtered, cached', lambda: server.listing(args.filter, 0)),
+    ]
+
+    print('{} applications, listing is {} bytes'.format(args.apps, len(server.listing('', 0))))
+    for name, call in cases:
+        print('{:20} {:10.0f} calls/s'.format(name, rate(call, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
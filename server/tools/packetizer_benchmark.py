@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+
+# packetizer_benchmark - Packets per second and CPU use of the RTP packetizer
+# Copyright (C) 2019 Lauri Peltonen
+
+# Pushes 48 kHz stereo L16 audio through RTPPacketizer to UDP receivers on
+# the loopback, at several packet sizes, with sendmmsg and with the sendto
+# fallback. For comparison the "naive" path builds a new bytes object and
+# calls sendto for every packet. Audio is pushed as fast as possible, so the
+# CPU time per second of audio is what the packetizer costs when streaming.
+#   python3 tools/packetizer_benchmark.py --seconds 20 --clients 1
+
+import argparse
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import RTPServer
+
+RATE = 48000
+FRAME = 4	# Bytes per frame of 16-bit stereo
+PUSH = 4096	# Bytes per buffer from the capture, like alsasrc
+
+
+class NaivePacketizer():
+    """One new packet and one sendto per packet and client"""
+
+    def __init__(self, sock, type=99, payloadSize=1152):
+        self.sock = sock
+        self.type = type
+        self.payloadSize = payloadSize - payloadSize % FRAME
+        self.seq = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.ssrc = random.getrandbits(32)
+        self.pending = b''
+        self.clients = []
+        self.packets = 0
+        self.calls = 0
+
+    def addClient(self, host, port):
+        self.clients.append((host, port))
+
+    def push(self, data):
+        self.pending += bytes(data)
+        while len(self.pending) >= self.payloadSize:
+            payload, self.pending = self.pending[:self.payloadSize], self.pending[self.payloadSize:]
+            packet = struct.pack('!BBHII', 0x80, self.type, self.seq, self.timestamp, self.ssrc) + payload
+            self.seq = (self.seq + 1) & 0xFFFF
+            self.timestamp = (self.timestamp + len(payload) // FRAME) & 0xFFFFFFFF
+            for addr in self.clients:
+                self.sock.sendto(packet, addr)
+                self.calls += 1
+            self.packets += 1
+
+    def stats(self):
+        return {'packets': self.packets, 'calls': self.calls}
+
+
+def receivers(count):
+    socks = []
+    for n in range(count):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        s.bind(('127.0.0.1', 0))
+        s.setblocking(False)
+        socks.append(s)
+    return socks
+
+
+def drain(socks):
+    received = 0
+    for s in socks:
+        while True:
+            try:
+                s.recv(65536)
+            except BlockingIOError:
+                break
+            received += 1
+    return received
+
+
+def run(path, payloadSize, seconds, clients):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 22)
+    socks = receivers(clients)
+
+    batched = RTPServer.sendmmsg
+    if path == 'sendto':
+        RTPServer.sendmmsg = None	# Messages are built when the clients are added
+    try:
+        if path == 'naive':
+            packetizer = NaivePacketizer(sock, 99, payloadSize)
+        else:
+            packetizer = RTPServer.RTPPacketizer(sock, 99, payloadSize)
+        for s in socks:
+            packetizer.addClient('127.0.0.1', s.getsockname()[1])
+    finally:
+        RTPServer.sendmmsg = batched
+
+    audio = bytes(PUSH)
+    pushes = int(seconds * RATE * FRAME / PUSH)
+    received = 0
+
+    wall = cpu = 0.0
+    for n in range(pushes):
+        started, startedCPU = time.perf_counter(), time.process_time()
+        packetizer.push(audio)
+        wall += time.perf_counter() - started
+        cpu += time.process_time() - startedCPU
+        if n % 16 == 15:	# Keep the receive buffers from overflowing, not timed
+            received += drain(socks)
+    received += drain(socks)
+
+    for s in socks + [sock]:
+        s.close()
+
+    stats = packetizer.stats()
+    audioSeconds = pushes * PUSH / float(RATE * FRAME)
+    return {
+        'packets': stats['packets'] / wall,
+        'calls': stats['calls'] / audioSeconds,
+        'cpu': 100.0 * cpu / audioSeconds,
+        'lost': stats['packets'] * clients - received,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the RTP packetizer')
+    parser.add_argument('-s', '--seconds', help='Seconds of audio to push per run', default=20, type=float)
+    parser.add_argument('-c', '--clients', help='Number of receivers', default=1, type=int)
+    parser.add_argument('-p', '--payload', help='Payload sizes in bytes', default=[256, 576, 1152], type=int, nargs='+')
+    args = parser.parse_args()
+
+    paths = ['naive', 'sendto'] + (['sendmmsg'] if RTPServer.sendmmsg is not None else [])
+    print('{} s of 48 kHz stereo L16 per run, {} client(s)'.format(args.seconds, args.clients))
+    print('{:>8} {:>9} {:>12} {:>14} {:>16} {:>6}'.format('payload', 'path', 'packets/s', 'syscalls/s*', 'CPU % of real*', 'lost'))
+    for payloadSize in args.payload:
+        for path in paths:
+            r = run(path, payloadSize, args.seconds, args.clients)
+            print('{:8} {:>9} {:12.0f} {:14.0f} {:16.2f} {:6}'.format(payloadSize, path, r['packets'], r['calls'], r['cpu'], r['lost']))
+    print('* per second of audio, i.e. when streaming in real time')
+
+
+if __name__ == '__main__':
+    main()
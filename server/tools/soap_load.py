@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# soap_load - GetApplicationList latency of concurrent clients during a launch
+# Copyright (C) 2019 Lauri Peltonen
+
+# Runs a number of clients calling GetApplicationList in a loop, and in the
+# middle of the run launches an application (e.g. a VNC app, which starts
+# Xvnc). The latencies of the calls that overlapped the launch are reported
+# separately from the others. If the server blocked on the launch, the tail
+# of the overlapping calls is about the launch time.
+#
+#   python3 tools/soap_load.py --app VNC --clients 4 --seconds 10
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+
+def listLoop(server, stop, calls):
+    """Call GetApplicationList until stopped, collecting (start, end) times"""
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            server.call('GetApplicationList', AppListingFilter='', ProfileID=0)
+        except Exception as e:
+            print('GetApplicationList failed: {}'.format(e))
+            continue
+        calls.append((started, time.perf_counter()))
+
+
+def summary(name, latencies):
+    if not latencies:
+        print('{:10} no calls'.format(name))
+        return
+    print('{:10} {:5} calls  p50 {:7.1f} ms  p95 {:7.1f} ms  p99 {:7.1f} ms  max {:7.1f} ms'.format(
+        name, len(latencies),
+        tmclient.percentile(latencies, 50) * 1000, tmclient.percentile(latencies, 95) * 1000,
+        tmclient.percentile(latencies, 99) * 1000, max(latencies) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GetApplicationList latency while an application is launched')
+    parser.add_argument('-l', '--location', help='Device description URL, searched if not given')
+    parser.add_argument('-a', '--app', help='Name of the application to launch', required=True)
+    parser.add_argument('-c', '--clients', help='Number of concurrent clients', default=4, type=int)
+    parser.add_argument('-s', '--seconds', help='Length of the run (s), the launch is in the middle', default=10, type=float)
+    parser.add_argument('--keep', help='Do not terminate the application after the run', action='store_true')
+    args = parser.parse_args()
+
+    server = tmclient.findServer(args.location)
+    appID = server.applications().get(args.app)
+    if appID is None:
+        print('No application named {}'.format(args.app))
+        return 1
+
+    stop = threading.Event()
+    calls = []	# list.append is atomic, shared by the clients
+    clients = [threading.Thread(target=listLoop, args=(tmclient.ApplicationServer(server.location), stop, calls))
+               for n in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    time.sleep(args.seconds / 2)
+    launchStarted = time.perf_counter()
+    uri = server.call('LaunchApplication', AppID=appID, ProfileID=0).get('AppURI')
+    launchEnded = time.perf_counter()
+    print('LaunchApplication took {:.1f} ms: {}'.format((launchEnded - launchStarted) * 1000, uri))
+
+    time.sleep(args.seconds / 2)
+    stop.set()
+    for client in clients:
+        client.join()
+
+    if not args.keep:
+        server.call('TerminateApplication', AppID=appID, ProfileID=0)
+
+    overlapping = [end - start for start, end in calls if start < launchEnded and end > launchStarted]
+    others = [end - start for start, end in calls if not (start < launchEnded and end > launchStarted)]
+    summary('launching', overlapping)
+    summary('idle', others)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
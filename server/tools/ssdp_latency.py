@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# ssdp_latency - M-SEARCH to response latency of the SSDP responder
+# Copyright (C) 2019 Lauri Peltonen
+
+# Sends M-SEARCHes for the server device type, the root device and ssdp:all
+# and reports the delay to the first response and the number of responses.
+# The MX of the searches is 3 s, so a responder that waits a random part of
+# MX instead of answering at once shows up as a long tail. To test
+# on the device itself, search through the loopback or the gadget interface:
+#   python3 tools/ssdp_latency.py --interface 192.168.10.1 --rounds 200
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+TARGETS = [tmclient.SERVER_TYPE, 'upnp:rootdevice', 'ssdp:all']
+
+
+def searchOnce(st, mx, window, interface):
+    """Returns seconds to each response received within the window"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    if interface:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    try:
+        delays = []
+        started = time.perf_counter()
+        sock.sendto(tmclient.searchRequest(mx, st), tmclient.SSDP_ADDR)
+        deadline = started + window
+        while True:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                return delays
+            sock.settimeout(left)
+            try:
+                data, addr = sock.recvfrom(4096)
+            except socket.timeout:
+                return delays
+            if data.startswith(b'HTTP/1.1 200'):
+                delays.append(time.perf_counter() - started)
+    finally:
+        sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the SSDP M-SEARCH response latency')
+    parser.add_argument('-i', '--interface', help='Interface (address) to search through, e.g. 127.0.0.1')
+    parser.add_argument('-n', '--rounds', help='Searches per target', default=100, type=int)
+    parser.add_argument('-m', '--mx', help='MX of the searches (s)', default=3, type=int)
+    parser.add_argument('-w', '--window', help='Time to collect responses of a search (s)', default=0.5, type=float)
+    parser.add_argument('-s', '--st', help='Search only this target', action='append')
+    args = parser.parse_args()
+
+    print('{:46} {:>5} {:>9} {:>9} {:>9} {:>10}'.format('ST', 'found', 'p50 ms', 'p95 ms', 'max ms', 'responses'))
+    for st in args.st or TARGETS:
+        first = []
+        responses = 0
+        for n in range(args.rounds):
+            delays = searchOnce(st, args.mx, args.window, args.interface)
+            if delays:
+                first.append(delays[0])
+            responses += len(delays)
+            time.sleep(0.01)	# Do not look like a search storm
+
+        print('{:46} {:5} {:9.2f} {:9.2f} {:9.2f} {:10.1f}'.format(
+            st, len(first), tmclient.percentile(first, 50) * 1000, tmclient.percentile(first, 95) * 1000,
+            max(first) * 1000 if first else float('nan'), responses / float(args.rounds)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+# startup_benchmark - Import times of the servers and time to the first SSDP response
+# Copyright (C) 2019 Lauri Peltonen
+
+# 1. python3 -X importtime breakdown of ApplicationServer, the slowest imports first.
+# 2. The UPnP server runs on Python 2, which has no -X importtime, so its main
+#    imports are timed one after another in a fresh interpreter instead.
+# 3. Time from starting upnp/UPnPServer.py (optionally --local) to the first
+#    answer to an M-SEARCH and to the first answered GetApplicationList.
+# Run on the device with no servers running, e.g.
+#   python3 tools/startup_benchmark.py --interface 192.168.10.1 --runs 5
+
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# In the order UPnPServer.py imports them, each includes what the previous ones did not
+UPNP_MODULES = ['twisted.internet.reactor', 'pyupnp.upnp', 'TmSSDP', 'TmUPnP', 'TmServerDevice', 'UPnPServer']
+
+STEP_TIMER = '''
+import sys, time
+sys.argv = ['UPnPServer.py']
+sys.path[:0] = ['upnp', '.']
+for name in sys.argv[1:] or {modules!r}:
+    started = time.time()
+    __import__(name)
+    print('%s %f' % (name, time.time() - started))
+'''
+
+
+def importTimes(python, module, top):
+    """Cumulative import time (s) of the module and of the modules it imports directly"""
+    result = subprocess.run([python, '-X', 'importtime', '-c', 'import ' + module], cwd=SERVER_DIR,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+        return []
+
+    # Modules are listed after what they import, indented two spaces per level
+    block = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        if depth == 1:
+            block.append((int(cumulative) / 1e6, '  ' + name.strip()))
+        elif depth == 0:
+            if name.strip() == module:
+                block.sort(reverse=True)
+                return [(int(cumulative) / 1e6, module)] + block[:top]
+            block = []
+    return []
+
+
+def stepTimes(python, modules):
+    """Import times (s) of the modules imported one after another"""
+    result = subprocess.run([python, '-c', STEP_TIMER.format(modules=modules)], cwd=SERVER_DIR,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        print(result.stderr.strip().splitlines()[-1])
+    times = []
+    for line in result.stdout.splitlines():
+        name, seconds = line.split()
+        times.append((float(seconds), name))
+    return times
+
+
+def firstResponse(python, interface, local, timeout):
+    """Seconds from start to the first SSDP response and to the first action, or None"""
+    command = [python, os.path.join('upnp', 'UPnPServer.py'), '--interface={}'.format(interface)]
+    if local:
+        command += ['--local', '--kill']
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, cwd=SERVER_DIR, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            preexec_fn=os.setsid)
+    discovered = answered = None
+    try:
+        while time.perf_counter() - started < timeout and proc.poll() is None:
+            location, took = tmclient.search(0.05, interface)
+            if location is not None:
+                discovered = time.perf_counter() - started
+                break
+
+        while discovered is not None and time.perf_counter() - started < timeout:
+            try:
+                tmclient.ApplicationServer(location).applications()
+                answered = time.perf_counter() - started
+                break
+            except Exception:
+                time.sleep(0.05)	# Not yet listening, or the application server is still starting
+    finally:
+        proc.stdin.close()	# UPnP server stops when its stdin is closed
+        proc.send_signal(signal.SIGINT)
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+    return discovered, answered
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the server startup')
+    parser.add_argument('-i', '--interface', help='Interface (address) to serve', default='192.168.10.1')
+    parser.add_argument('-n', '--runs', help='Server starts to time', default=5, type=int)
+    parser.add_argument('-l', '--local', help='Start the UPnP server with --local', action='store_true')
+    parser.add_argument('-t', '--timeout', help='Time to wait for the server to answer (s)', default=60, type=float)
+    parser.add_argument('--top', help='Number of imports to list', default=15, type=int)
+    parser.add_argument('--python2', help='Interpreter of the UPnP server', default='python')
+    parser.add_argument('--imports-only', help='Only measure the imports', action='store_true')
+    args = parser.parse_args()
+
+    print('python3 -X importtime ApplicationServer, cumulative:')
+    for seconds, name in importTimes('python3', 'ApplicationServer', args.top):
+        print('  {:8.1f} ms  {}'.format(seconds * 1000, name))
+
+    print('{} UPnP server imports, one after another:'.format(args.python2))
+    for seconds, name in stepTimes(args.python2, UPNP_MODULES):
+        print('  {:8.1f} ms  {}'.format(seconds * 1000, name))
+
+    if args.imports_only:
+        return
+
+    print('UPnPServer.py{} start to first response:'.format(' --local' if args.local else ''))
+    for run in range(args.runs):
+        discovered, answered = firstResponse(args.python2, args.interface, args.local, args.timeout)
+        print('  run {}: SSDP {}, GetApplicationList {}'.format(run + 1,
+              '{:.2f} s'.format(discovered) if discovered is not None else 'no answer',
+              '{:.2f} s'.format(answered) if answered is not None else 'no answer'))
+        time.sleep(1)	# Let the ports be released
+
+
+if __name__ == '__main__':
+    main()
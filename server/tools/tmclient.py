@@ -0,0 +1,164 @@
+# tmclient - Minimal TM-Link control point for the measurement tools
+# Copyright (C) 2019 Lauri Peltonen
+
+# Only the standard library is used, so the tools run on the host as well
+# as on the device without the UPnP client libraries.
+
+import http.client
+import socket
+import time
+import xml.etree.ElementTree as ET
+from urllib.parse import urljoin, urlparse
+
+SERVER_TYPE = 'urn:schemas-upnp-org:device:TmServerDevice:1'
+APP_SERVER_TYPE = 'urn:schemas-upnp-org:service:TmApplicationServer:1'
+SSDP_ADDR = ('239.255.255.250', 1900)
+
+DEVICE_NS = '{urn:schemas-upnp-org:device-1-0}'
+SOAP_ENVELOPE = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body><u:{action} xmlns:u="{serviceType}">{arguments}</u:{action}></s:Body>
+</s:Envelope>'''
+
+
+def searchRequest(mx=1, st=SERVER_TYPE):
+    return '\r\n'.join([
+        'M-SEARCH * HTTP/1.1',
+        'HOST: {}:{}'.format(*SSDP_ADDR),
+        'MAN: "ssdp:discover"',
+        'MX: {}'.format(mx),
+        'ST: {}'.format(st),
+        '', '']).encode()
+
+
+def parseHeaders(data):
+    headers = {}
+    for line in data.decode(errors='replace').split('\r\n')[1:]:
+        key, sep, value = line.partition(':')
+        if sep:
+            headers[key.strip().upper()] = value.strip()
+    return headers
+
+
+def search(timeout=5, interface=None):
+    """M-SEARCH for the server, returns (location, seconds to the response) or (None, None)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    if interface:
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+    try:
+        started = time.perf_counter()
+        sock.sendto(searchRequest(), SSDP_ADDR)
+        deadline = started + timeout
+        while True:
+            left = deadline - time.perf_counter()
+            if left <= 0:
+                return None, None
+            sock.settimeout(left)
+            try:
+                data, addr = sock.recvfrom(4096)
+            except socket.timeout:
+                return None, None
+            headers = parseHeaders(data)
+            if headers.get('ST') == SERVER_TYPE and 'LOCATION' in headers:
+                return headers['LOCATION'], time.perf_counter() - started
+    finally:
+        sock.close()
+
+
+def localAddress(url):
+    """Local address the host of the URL is reached from, e.g. for GENA callbacks"""
+    part = urlparse(url)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((part.hostname, part.port or 80))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+
+def request(url, method='GET', body=None, headers=None, timeout=10):
+    """Return (status, response headers, body) of one HTTP request"""
+    part = urlparse(url)
+    conn = http.client.HTTPConnection(part.hostname, part.port or 80, timeout=timeout)
+    try:
+        path = part.path or '/'
+        if part.query:
+            path += '?' + part.query
+        conn.request(method, path, body, headers or {})
+        response = conn.getresponse()
+        return response.status, dict((k.upper(), v) for k, v in response.getheaders()), response.read()
+    finally:
+        conn.close()
+
+
+class ApplicationServer:
+    """TmApplicationServer service of the device at the location"""
+
+    def __init__(self, location):
+        self.location = location
+        status, headers, body = request(location)
+        root = ET.fromstring(body)
+
+        base = root.findtext(DEVICE_NS + 'URLBase') or location
+        self.controlURL = None
+        self.eventURL = None
+        for service in root.iter(DEVICE_NS + 'service'):
+            if service.findtext(DEVICE_NS + 'serviceType') == APP_SERVER_TYPE:
+                self.controlURL = urljoin(base, service.findtext(DEVICE_NS + 'controlURL'))
+                self.eventURL = urljoin(base, service.findtext(DEVICE_NS + 'eventSubURL'))
+        if self.controlURL is None:
+            raise ValueError('No TmApplicationServer at {}'.format(location))
+
+    def call(self, action, **arguments):
+        """Call the action, returns dict of the out arguments"""
+        body = SOAP_ENVELOPE.format(action=action, serviceType=APP_SERVER_TYPE, arguments=''.join(
+            '<{0}>{1}</{0}>'.format(key, value) for key, value in arguments.items()))
+        headers = {
+            'Content-Type': 'text/xml; charset="utf-8"',
+            'SOAPACTION': '"{}#{}"'.format(APP_SERVER_TYPE, action),
+        }
+        status, headers, data = request(self.controlURL, 'POST', body.encode(), headers)
+        if status != 200:
+            raise RuntimeError('{} failed with HTTP {}: {}'.format(action, status, data[:200]))
+
+        response = ET.fromstring(data).find('.//{{{}}}{}Response'.format(APP_SERVER_TYPE, action))
+        if response is None:	# SOAPpy may leave the response element without namespace
+            response = ET.fromstring(data).find('.//{}Response'.format(action))
+        return dict((child.tag.split('}')[-1], child.text or '') for child in response)
+
+    def applications(self):
+        """Return dict of application name -> app ID"""
+        listing = self.call('GetApplicationList', AppListingFilter='', ProfileID=0)['AppListing']
+        root = ET.fromstring(listing.encode())
+        return dict((app.findtext('name'), app.findtext('appID')) for app in root.findall('app'))
+
+    def subscribe(self, callback, timeout=300):
+        """Subscribe to the events, returns the SID"""
+        status, headers, body = request(self.eventURL, 'SUBSCRIBE', None, {
+            'CALLBACK': '<{}>'.format(callback),
+            'NT': 'upnp:event',
+            'TIMEOUT': 'Second-{}'.format(timeout),
+        })
+        if status != 200:
+            raise RuntimeError('SUBSCRIBE failed with HTTP {}'.format(status))
+        return headers.get('SID')
+
+    def unsubscribe(self, sid):
+        request(self.eventURL, 'UNSUBSCRIBE', None, {'SID': sid})
+
+
+def findServer(location=None, timeout=5):
+    """Return ApplicationServer of the given or the first found server"""
+    if location is None:
+        location, took = search(timeout)
+        if location is None:
+            raise RuntimeError('No TM-Link server found')
+    return ApplicationServer(location)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
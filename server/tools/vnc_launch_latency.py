@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# vnc_launch_latency - Time from LaunchApplication to the first VNC framebuffer update
+# Copyright (C) 2019 Lauri Peltonen
+
+# Starts upnp/UPnPServer.py --local with a registry of one terminable VNC
+# application, and with a VNC pool unless --no-pool is given. The application
+# is then launched and terminated repeatedly. Each run connects to the
+# returned VNC URI as an RFB client and times the first FramebufferUpdate.
+# Between the runs the pool has --settle seconds to start a new Xvnc.
+# Run on the device with no servers running, e.g.
+#   python3 tools/vnc_launch_latency.py --interface 192.168.10.1
+#   python3 tools/vnc_launch_latency.py --interface 192.168.10.1 --no-pool
+
+import argparse
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tmclient
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+REGISTRY = {'applications': [{'id': 'vnc', 'type': 'VNC', 'name': 'VNC latency', 'geometry': '800x600'}]}
+
+
+def recvExactly(sock, count):
+    data = b''
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise IOError('VNC server closed the connection')
+        data += chunk
+    return data
+
+
+def connect(host, port, timeout):
+    """Connect to the VNC server, retrying while Xvnc is still starting"""
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port), timeout=timeout)
+        except (ConnectionRefusedError, socket.timeout):
+            if time.perf_counter() > deadline:
+                raise
+            time.sleep(0.02)
+
+
+def firstUpdate(uri, timeout):
+    """Do the RFB handshake without authentication and wait for the first FramebufferUpdate"""
+    part = urlparse(uri)
+    sock = connect(part.hostname, part.port, timeout)
+    try:
+        version = recvExactly(sock, 12)
+        minor = min(int(version[8:11]), 8)
+        sock.sendall('RFB 003.{:03}\n'.format(minor).encode())
+        if minor >= 7:
+            count = recvExactly(sock, 1)[0]
+            if count == 0 or 1 not in recvExactly(sock, count):
+                raise IOError('VNC server needs authentication')
+            sock.sendall(b'\x01')	# None
+            if minor >= 8 and struct.unpack('!I', recvExactly(sock, 4))[0] != 0:
+                raise IOError('VNC security handshake failed')
+        elif struct.unpack('!I', recvExactly(sock, 4))[0] != 1:
+            raise IOError('VNC server needs authentication')
+
+        sock.sendall(b'\x01')	# ClientInit, shared
+        width, height = struct.unpack('!HH', recvExactly(sock, 4))
+        recvExactly(sock, 16)	# Pixel format
+        recvExactly(sock, struct.unpack('!I', recvExactly(sock, 4))[0])	# Desktop name
+
+        sock.sendall(struct.pack('!BxHi', 2, 1, 0))	# SetEncodings: Raw
+        sock.sendall(struct.pack('!BBHHHH', 3, 0, 0, 0, width, height))	# Full FramebufferUpdateRequest
+        while True:
+            kind = recvExactly(sock, 1)[0]
+            if kind == 0:	# FramebufferUpdate
+                return
+            if kind == 1:	# SetColourMapEntries
+                first, count = struct.unpack('!xHH', recvExactly(sock, 5))
+                recvExactly(sock, 6 * count)
+            elif kind != 2:	# Bell has no payload
+                raise IOError('Unexpected VNC message {}'.format(kind))
+    finally:
+        sock.close()
+
+
+def startServer(interface, config, pool):
+    command = ['python', os.path.join('upnp', 'UPnPServer.py'), '--interface={}'.format(interface),
+               '--local', '--kill', '--config={}'.format(config), '--vnc-pool={}'.format(pool)]
+    print('Starting: {}'.format(' '.join(command)))
+    return subprocess.Popen(command, cwd=SERVER_DIR, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            preexec_fn=os.setsid)
+
+
+def stopServer(proc):
+    proc.stdin.close()	# UPnP server stops when its stdin is closed
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        os.killpg(proc.pid, signal.SIGKILL)
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure VNC application launch latency')
+    parser.add_argument('-i', '--interface', help='Interface (address) to serve', default='192.168.10.1')
+    parser.add_argument('-n', '--runs', help='Launches to time', default=5, type=int)
+    parser.add_argument('--no-pool', help='Start the server without pre-started VNC servers', action='store_true')
+    parser.add_argument('-s', '--settle', help='Seconds between the runs, to let the pool start a new server', default=10, type=float)
+    parser.add_argument('-t', '--timeout', help='Time to wait for the server and Xvnc (s)', default=60, type=float)
+    args = parser.parse_args()
+
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(REGISTRY, f)
+        config = f.name
+
+    proc = startServer(args.interface, config, 0 if args.no_pool else 1)
+    try:
+        started = time.perf_counter()
+        server = apps = None
+        while apps is None and time.perf_counter() - started < args.timeout and proc.poll() is None:
+            try:
+                location, took = tmclient.search(0.2, args.interface)
+                if location is not None:
+                    server = tmclient.ApplicationServer(location)
+                    apps = server.applications()
+            except Exception:
+                time.sleep(0.1)	# Application server is still starting
+        if not apps:
+            sys.exit('Server did not answer')
+        appID = apps['VNC latency']
+
+        time.sleep(args.settle)	# Let the pool start its server
+        launches, updates = [], []
+        for run in range(args.runs):
+            requested = time.perf_counter()
+            uri = server.call('LaunchApplication', AppID=appID, ProfileID=0)['AppURI']
+            responded = time.perf_counter()
+            if not uri:
+                print('  run {}: launch failed'.format(run + 1))
+            else:
+                firstUpdate(uri, args.timeout)
+                updated = time.perf_counter()
+                launches.append(responded - requested)
+                updates.append(updated - requested)
+                print('  run {}: LaunchApplication {:.3f} s, first framebuffer update {:.3f} s ({:.3f} s after the response)'.format(
+                    run + 1, responded - requested, updated - requested, updated - responded))
+            server.call('TerminateApplication', AppID=appID, ProfileID=0)
+            time.sleep(args.settle)
+
+        print('{}: LaunchApplication p50 {:.3f} s, first framebuffer update p50 {:.3f} s, max {:.3f} s'.format(
+            'without pool' if args.no_pool else 'with pool', tmclient.percentile(launches, 50),
+            tmclient.percentile(updates, 50), max(updates) if updates else float('nan')))
+    finally:
+        stopServer(proc)
+        os.unlink(config)
+
+
+if __name__ == '__main__':
+    main()
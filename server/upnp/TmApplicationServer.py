@@ -24,10 +24,7 @@
 #	[ ] Implement interface to register applications
 #	[ ] Implement interface to launch / terminate applications
 
-#from twisted.internet import reactor
-#from txdbus import error, client
-
-import dbus
+from twisted.internet import reactor, defer
 
 from pyupnp.logr import Logr
 
@@ -36,6 +33,9 @@ from pyupnp.services import Service, register_action,\
     ServiceActionArgument, ServiceStateVariable
 from pyupnp.upnp import upnpError
 
+from TmSession import sessionPath
+
+
 class TmApplicationServer(Service):
     version = (1, 0)
     serviceType = "urn:schemas-upnp-org:service:TmApplicationServer:1"
@@ -106,34 +106,143 @@ class TmApplicationServer(Service):
     ]
 
     # Events that can be registered to
+    # These are updated from the application server D-BUS signals
     app_status_update = EventProperty('AppStatusUpdate')
     app_list_update = EventProperty('AppListUpdate')
-    # TODO: How to handle the changes...?
 
 
-    def __init__(self):
+    def __init__(self, appServer=None, session=0, local=False):
         Service.__init__(self)
 
-        # Initialize D-BUS connection to the application server
-        self.dbus = dbus.SessionBus()
-        self.session = self.dbus.get_object('org.tmlink', '/org/tmlink')
-        self.iface = dbus.Interface(self.session, 'org.tmlink.ApplicationServer')
+        # Application server running in the same process, if given the
+        # methods are called directly instead of over D-BUS. With local
+        # but no server yet, calls wait until setAppServer is called.
+        self.appServer = None
+        self.local = local or appServer is not None
+
+        # D-BUS connection to the application server is made through txdbus,
+        # so the calls return Deferreds and do not block the reactor
+        self.path = sessionPath(session)
+        self.remote = None
+        self.waiting = []	# Deferreds waiting for the connection or the local server
+        self.failure = None	# Set if the local server could not be started
+
+        if appServer is not None:
+            self.setAppServer(appServer)
+        elif not self.local:
+            self.getRemote()
+
+    def setAppServer(self, appServer):
+        """Use the application server running in this process"""
+        self.appServer = appServer
+        appServer.addListener(self)
+
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(appServer)
+
+    def appServerFailed(self, failure):
+        """Local application server could not be started, fail the waiting and later calls"""
+        Logr.error('Application server not available: %s', failure.getErrorMessage())
+        self.failure = failure
+
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(upnpError(501, 'Action Failed'))
+
+    def getRemote(self):
+        """Return Deferred that fires with the application server object"""
+        if self.remote is not None:
+            return defer.succeed(self.remote)
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        if len(self.waiting) == 1:	# Not yet connecting
+            from txdbus import client	# Only needed when not running in-process
+            c = client.connect(reactor, 'session')
+            c.addCallback(lambda conn: conn.getRemoteObject('org.tmlink', self.path))
+            c.addCallbacks(self.connected, self.connectFailed)
+        return d
+
+    def connected(self, remote):
+        self.remote = remote
+
+        remote.notifyOnSignal('ApplicationStatusChanged', self.applicationStatusChanged, interface='org.tmlink.ApplicationServer')
+        remote.notifyOnSignal('ApplicationListChanged', self.applicationListChanged, interface='org.tmlink.ApplicationServer')
+
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(remote)
+
+    def connectFailed(self, failure):
+        Logr.warning('Could not connect to application server: %s', failure.getErrorMessage())
+
+        # Next call will try again
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.errback(failure)
+
+    def callRemote(self, method, *args):
+        """Call application server method, returns Deferred"""
+        if self.appServer is not None:
+            return defer.maybeDeferred(getattr(self.appServer, method), *args)
+
+        if self.failure is not None:
+            return defer.fail(upnpError(501, 'Action Failed'))
+
+        if self.local:	# Application server is still starting
+            d = defer.Deferred()
+            self.waiting.append(d)
+            d.addCallback(lambda appServer: getattr(appServer, method)(*args))
+            return d
+
+        d = self.getRemote()
+        d.addCallback(lambda remote: remote.callRemote(method, *args, interface='org.tmlink.ApplicationServer'))
+        return d
+
+    def applicationStatusChanged(self, appIDs):
+        # Application server collects the changes of one event window into a single signal
+        self.app_status_update = appIDs
+
+    def applicationListChanged(self, appIDs):
+        self.app_list_update = appIDs
 
     @register_action('GetApplicationList')
     def getApplicationList(self, appListingFilter, profileID):
-        return {'AppListing': self.iface.ApplicationList()}
+        try:
+            profileID = int(profileID or 0)
+        except ValueError:
+            raise upnpError(830, 'Invalid Profile ID')
+
+        def invalidFilter(failure):
+            # Other errors, e.g. the application server not running, are 501 Action Failed.
+            # The name is in errName over D-BUS and in the exception itself in-process.
+            name = getattr(failure.value, 'errName', None) or getattr(failure.value, '_dbus_error_name', None)
+            if name != 'org.tmlink.ApplicationServer.InvalidFilter':
+                return failure
+            raise upnpError(402, 'Invalid Args')	# Filter could not be parsed
+
+        d = self.callRemote('ApplicationList', appListingFilter or '', profileID)
+        d.addCallbacks(lambda appList: {'AppListing': appList}, invalidFilter)
+        return d
 
     @register_action('LaunchApplication')
     def launchApplication(self, appID, profileID):
-        return {'AppURI': self.iface.LaunchApplication(appID)}
+        d = self.callRemote('LaunchApplication', appID)
+        d.addCallback(lambda uri: {'AppURI': uri})
+        return d
 
     @register_action('TerminateApplication')
     def terminateApplication(self, appID, profileID):
-        return {'TerminationResult': self.iface.TerminateApplication(appID)}
+        d = self.callRemote('TerminateApplication', appID)
+        d.addCallback(lambda result: {'TerminationResult': result})
+        return d
 
     @register_action('GetApplicationStatus')
     def getApplicationStatus(self, appID):
-        return {'AppStatus': self.iface.GetApplicationStatus(appID)}
+        d = self.callRemote('GetApplicationStatus', appID)
+        d.addCallback(lambda status: {'AppStatus': status})
+        return d
 
     @register_action('GetApplicationCertificateInfo')
     def getApplicationCertificateInfo(self, appID):
@@ -0,0 +1,344 @@
+# TmSSDP - SSDP responder for the point-to-point TM-Link connection
+# Copyright (C) 2019 Lauri Peltonen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# The TM-Link server is found over a USB network link that has only the
+# client on the other end, so the random MX delay that spreads responses
+# of many devices is not needed. All datagrams are rendered once when
+# the location is known, and alive notifications are sent in a burst
+# whenever the link comes up, so the client does not need to search at all.
+
+import random
+import socket
+import struct
+import time
+
+from twisted.internet import reactor, task
+from twisted.internet.protocol import DatagramProtocol
+
+from pyupnp.logr import Logr
+
+
+SSDP_ADDR = '239.255.255.250'
+SSDP_PORT = 1900
+
+# Netlink route groups and messages for following the interfaces
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTM_NEWLINK = 16
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFF_RUNNING = 0x40
+
+
+def addressAssigned(address):
+    """Return True if the address belongs to a local interface"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.bind((address, 0))
+        return True
+    except socket.error:
+        return False
+    finally:
+        s.close()
+
+
+def sourceAddress(address):
+    """Return the local address used to reach the given address"""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((address, SSDP_PORT))	# Only selects the route, nothing is sent
+        return s.getsockname()[0]
+    except socket.error:
+        return None
+    finally:
+        s.close()
+
+
+def renderMessage(startLine, headers):
+    lines = [startLine] + ['%s: %s' % (key, value) for key, value in headers]
+    return '\r\n'.join(lines) + '\r\n\r\n'
+
+
+def addressAttributes(data, offset, end):
+    """Return the IPv4 addresses in the rtattrs of an RTM_NEWADDR message"""
+    addresses = []
+    while offset + 4 <= end:
+        length, attrType = struct.unpack_from('=HH', data, offset)
+        if length < 4:
+            break
+        if attrType in (IFA_ADDRESS, IFA_LOCAL) and length == 8:
+            addresses.append(socket.inet_ntoa(data[offset + 4:offset + 8]))
+        offset += (length + 3) & ~3
+    return addresses
+
+
+class LinkMonitor(object):
+    """Calls back when the interface of the address or the address comes up, using rtnetlink
+
+    The interface is found from the address messages, so that the changes of
+    other interfaces do not announce the device again.
+    """
+
+    dumpSeq = 1
+
+    def __init__(self, callback, address):
+        self.callback = callback
+        self.address = address
+        self.ifindex = None	# Interface that has the address, learned from RTM_NEWADDR
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR))
+        self.sock.setblocking(False)
+        self.portID = self.sock.getsockname()[0]
+
+    def start(self):
+        # Ask for the current addresses, the answers tell the interface of the address
+        request = struct.pack('=IHHIIBBBBI', 24, RTM_GETADDR, NLM_F_REQUEST | NLM_F_DUMP,
+                              self.dumpSeq, 0, socket.AF_INET, 0, 0, 0, 0)
+        self.sock.send(request)
+        reactor.addReader(self)
+
+    def stop(self):
+        reactor.removeReader(self)
+        self.sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def logPrefix(self):
+        return 'LinkMonitor'
+
+    def connectionLost(self, reason):
+        pass
+
+    def doRead(self):
+        up = False
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error:
+                break
+
+            offset = 0
+            while offset + 16 <= len(data):
+                length, msgType, msgFlags, seq, portID = struct.unpack_from('=IHHII', data, offset)
+                if length < 16:
+                    break
+                end = min(offset + length, len(data))
+                if msgType == RTM_NEWADDR and offset + 24 <= end:
+                    # ifaddrmsg follows the header, then the address attributes
+                    index = struct.unpack_from('=I', data, offset + 20)[0]
+                    if self.address in addressAttributes(data, offset + 24, end):
+                        self.ifindex = index
+                        if (seq, portID) != (self.dumpSeq, self.portID):	# Answers to the dump are not changes
+                            up = True
+                elif msgType == RTM_NEWLINK and offset + 32 <= end:
+                    # ifinfomsg follows the header, interface got carrier if RUNNING changed on
+                    index, flags, change = struct.unpack_from('=iII', data, offset + 20)
+                    if index == self.ifindex and flags & change & IFF_RUNNING:
+                        up = True
+                offset += (length + 3) & ~3
+
+        self.callback(up)
+
+
+class TmSSDP(DatagramProtocol):
+    def __init__(self, device, host, notifyInterval=1800, maxDelay=0,
+                 burstCount=3, burstInterval=0.2):
+        """SSDP responder and notifier on a single interface
+
+        :type device: Device
+        """
+        self.device = device
+        self.host = host
+        self.notifyInterval = notifyInterval
+        self.maxDelay = maxDelay	# Upper limit for the MX delay, 0 responds immediately
+        self.burstCount = burstCount
+        self.burstInterval = burstInterval
+
+        if self.device.uuid is None:
+            raise ValueError()
+
+        # Notification types and the USNs sent with them
+        udn = 'uuid:' + self.device.uuid
+        self.targets = [
+            ('upnp:rootdevice', udn + '::upnp:rootdevice'),
+            (udn, udn),
+            (self.device.deviceType, udn + '::' + self.device.deviceType),
+        ]
+        for service in self.device.services:
+            self.targets.append((service.serviceType, udn + '::' + service.serviceType))
+
+        self.responses = {}	# ST -> list of response datagrams
+        self.alive = []
+        self.byebye = []
+
+        self.peers = {}	# Address -> True if it is reached through this interface
+        self.port = None
+        self.monitor = None
+        self.available = False
+        self.notifyLoop = task.LoopingCall(self.sendAlive)
+        self.rand = random.Random()
+
+    def render(self):
+        """Render all datagrams, must be done again if the location changes"""
+        if self.device.bootID is None:
+            self.device.bootID = int(time.time())
+
+        location = self.device.getLocation(self.host)
+        common = [
+            ('LOCATION', location),
+            ('SERVER', self.device.server),
+            ('BOOTID.UPNP.ORG', self.device.bootID),
+            ('CONFIGID.UPNP.ORG', self.device.configID),
+        ]
+
+        self.responses = {}
+        self.alive = []
+        self.byebye = []
+        for nt, usn in self.targets:
+            response = renderMessage('HTTP/1.1 200 OK', [
+                ('CACHE-CONTROL', 'max-age = %d' % (self.notifyInterval + 10 * 60)),
+                ('EXT', ''),
+                ('ST', nt),
+                ('USN', usn),
+            ] + common)
+            self.responses[nt] = [response]
+
+            self.alive.append(renderMessage('NOTIFY * HTTP/1.1', [
+                ('HOST', '%s:%d' % (SSDP_ADDR, SSDP_PORT)),
+                ('CACHE-CONTROL', 'max-age = %d' % (self.notifyInterval + 10 * 60)),
+                ('NT', nt),
+                ('NTS', 'ssdp:alive'),
+                ('USN', usn),
+            ] + common))
+
+            self.byebye.append(renderMessage('NOTIFY * HTTP/1.1', [
+                ('HOST', '%s:%d' % (SSDP_ADDR, SSDP_PORT)),
+                ('NT', nt),
+                ('NTS', 'ssdp:byebye'),
+                ('USN', usn),
+                ('BOOTID.UPNP.ORG', self.device.bootID),
+                ('CONFIGID.UPNP.ORG', self.device.configID),
+            ]))
+
+        self.responses['ssdp:all'] = [r[0] for r in self.responses.values()]
+
+    def listen(self):
+        Logr.debug("listen()")
+        self.render()
+        self.port = reactor.listenMulticast(SSDP_PORT, self, listenMultiple=True)
+
+        try:
+            self.monitor = LinkMonitor(self.linkEvent, self.host)
+            self.monitor.start()
+        except (socket.error, AttributeError):	# No netlink, poll the address instead
+            Logr.warning("Netlink not available, polling the interface")
+            self.monitor = task.LoopingCall(self.linkEvent, False)
+            self.monitor.start(1)
+
+        self.notifyLoop.start(self.notifyInterval / 2, now=False)
+
+    def stop(self):
+        Logr.debug("stop()")
+        if self.port is None:
+            return
+
+        if self.notifyLoop.running:
+            self.notifyLoop.stop()
+        self.monitor.stop()
+        self.port.stopListening()
+        self.port = None
+
+    def startProtocol(self):
+        self.transport.setTTL(2)
+        self.transport.setLoopbackMode(True)
+        self.linkEvent(True)
+
+    def linkEvent(self, up):
+        """Join the group and announce the device when the interface comes up"""
+        available = addressAssigned(self.host)
+        if available and (up or not self.available):
+            Logr.debug("interface %s up", self.host)
+            self.peers = {}	# Routes may have changed
+
+            # Joining fails if the group was already joined on the interface
+            self.transport.joinGroup(SSDP_ADDR, self.host).addErrback(lambda failure: None)
+            self.transport.setOutgoingInterface(self.host).addErrback(lambda failure: None)
+
+            for n in range(self.burstCount):
+                reactor.callLater(n * self.burstInterval, self.sendAlive)
+
+        self.available = available
+
+    def send(self, datagrams, address):
+        for datagram in datagrams:
+            try:
+                self.transport.write(datagram, address)
+            except socket.error as e:
+                Logr.warning("socket.error: %s", e)
+                return
+
+    def sendAlive(self):
+        if self.available:
+            self.send(self.alive, (SSDP_ADDR, SSDP_PORT))
+
+    def sendByebye(self):
+        if self.available:
+            self.send(self.byebye, (SSDP_ADDR, SSDP_PORT))
+
+    def datagramReceived(self, data, address):
+        # Only M-SEARCH is handled, so the request is not parsed further than needed
+        if not data.startswith('M-SEARCH'):
+            return
+
+        # All the sockets bound to the SSDP port get every search, answer
+        # only the ones that came through the interface of this device
+        peer = address[0]
+        if not peer in self.peers:
+            if len(self.peers) >= 64:
+                self.peers = {}
+            self.peers[peer] = sourceAddress(peer) == self.host
+        if not self.peers[peer]:
+            return
+
+        headers = {}
+        for line in data.split('\r\n')[1:]:
+            key, sep, value = line.partition(':')
+            if sep:
+                headers[key.strip().upper()] = value.strip()
+
+        if headers.get('MAN', '').strip('"') != 'ssdp:discover':
+            return
+
+        responses = self.responses.get(headers.get('ST'))
+        if responses is None:
+            return
+
+        try:
+            mx = int(headers.get('MX', 1))
+        except ValueError:
+            return
+
+        delay = min(mx, self.maxDelay)
+        if delay <= 0:
+            self.send(responses, address)
+        else:
+            reactor.callLater(self.rand.uniform(0, delay), self.send, responses, address)
@@ -18,13 +18,10 @@
 #from threading import Thread
 #import time
 #from twisted.internet import reactor
+import uuid
 import xml.etree.ElementTree as et
 from pyupnp.device import Device, DeviceIcon
-from pyupnp.logr import Logr
-from pyupnp.services import register_action
-from pyupnp.services.connection_manager import ConnectionManagerService
-from pyupnp.services.content_directory import ContentDirectoryService
-from pyupnp.services.microsoft.media_receiver_registrar import MediaReceiverRegistrarService
+from pyupnp.event import EventProperty
 #from ssdp import SSDP
 #from pyupnp.upnp import UPnP
 from pyupnp.util import make_element
@@ -33,6 +30,23 @@ from TmApplicationServer import TmApplicationServer
 from TmNotificationServer import TmNotificationServer
 from TmClientProfile import TmClientProfile
 
+def sessionService(cls, session):
+    """Return the service class to use in the n:th session
+
+    pyupnp keeps the event properties, and the service instance they notify,
+    in class attributes, so each session needs its own subclass of the service.
+    """
+    if session == 0:
+        return cls
+
+    attrs = {}
+    for klass in reversed(cls.__mro__):
+        for name, value in vars(klass).items():
+            if isinstance(value, EventProperty):
+                attrs[name] = EventProperty(value.name)
+    return type(cls.__name__, (cls,), attrs)
+
+
 class TmServerDevice(Device):
     deviceType = 'urn:schemas-upnp-org:device:TmServerDevice:1'
     friendlyName = 'TmDevice-TestUnit'
@@ -46,15 +60,20 @@ class TmServerDevice(Device):
     UPC = 'Universal Product Code'	# TODO: Add sensible one?
 
 
-    def __init__(self, address):
+    baseUUID = '2fac1234-31f8-11b4-a222-08002b34c003'
+
+    def __init__(self, address, appServer=None, session=0, local=False):
         Device.__init__(self)
         #super(Device, self).__init__()
 
-        self.uuid = '2fac1234-31f8-11b4-a222-08002b34c003'
+        # Every session (interface) is a separate device
+        self.uuid = TmServerDevice.baseUUID
+        if session > 0:
+            self.uuid = str(uuid.uuid5(uuid.UUID(TmServerDevice.baseUUID), address))
 
-        self.tmApplicationServer = TmApplicationServer()
-	self.tmNotificationServer = TmNotificationServer()
-	self.tmClientProfile = TmClientProfile()
+        self.tmApplicationServer = sessionService(TmApplicationServer, session)(appServer, session, local)
+	self.tmNotificationServer = sessionService(TmNotificationServer, session)()
+	self.tmClientProfile = sessionService(TmClientProfile, session)()
 
         self.services = [
             self.tmApplicationServer,
@@ -84,10 +103,33 @@ class TmServerDevice(Device):
         # List additional elements
         self.extraElements = [linkVersion]
 
+        # Rendered description, the document does not change until the
+        # base URL or the services change
+        self.description = None
+        self.listeners = []	# Told when the descriptions have to be rendered again
+
 
     def setBaseUrl(self, bind):
 #        Logr.debug('Device location is {}'.format(self.location))
         self.extras['URLBase'] = self.getLocation(bind)
+        self.invalidate()
+
+    def addListener(self, listener):
+        """Listener must have descriptionChanged() method, e.g. to drop served copies"""
+        self.listeners.append(listener)
+
+    def invalidate(self):
+        """Render the descriptions again on next request, e.g. after the services changed"""
+        self.description = None
+        for service in self.services:
+            service.dumps(force=True)	# SCPDs are cached in the service classes
+        for listener in self.listeners:
+            listener.descriptionChanged()
+
+    def dumps(self, force=False):
+        if self.description is None or force:
+            self.description = Device.dumps(self, force=True)
+        return self.description
 
     def dump_device(self):
         """Dump the device XML tree. This adds required additional fields"""
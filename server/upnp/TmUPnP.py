@@ -0,0 +1,177 @@
+# TmUPnP - UPnP control server that allows asynchronous actions
+# Copyright (C) 2019 Lauri Peltonen
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+# The pyUPnP control resource calls the action handlers synchronously.
+# This replaces the control resource with one that also accepts Deferreds
+# from the action handlers, so that e.g. a D-BUS call to the application
+# server does not block the reactor while it is in progress.
+#
+# The device and service descriptions are also served from memory with an
+# ETag, so that a client re-fetching them after reconnecting gets a 304.
+
+import hashlib
+
+from SOAPpy import parseSOAPRPC, buildSOAP
+from twisted.internet import defer
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from pyupnp.logr import Logr
+from pyupnp.upnp import UPnP, ServeResource, ServiceResource, ServiceControlResource, upnpError
+
+
+UPNP_ERROR = '''<?xml version="1.0" encoding="utf-8"?>
+<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
+<s:Body>
+<s:Fault>
+<faultcode>s:Client</faultcode>
+<faultstring>UPnPError</faultstring>
+<detail>
+<UPnPError xmlns="urn:schemas-upnp-org:control-1-0">
+<errorCode>{}</errorCode>
+<errorDescription>{}</errorDescription>
+</UPnPError>
+</detail>
+</s:Fault>
+</s:Body>
+</s:Envelope>'''
+
+
+class TmUPnP(UPnP):
+    """UPnP server where the service actions may return Deferreds"""
+
+    def __init__(self, device):
+        UPnP.__init__(self, device)
+        self.descriptions = {}	# Path -> DescriptionResource
+        device.addListener(self)
+
+    def descriptionChanged(self):
+        """Device rendered its descriptions again, e.g. after the base URL changed"""
+        self.descriptions = {}
+
+    def description(self, path, render):
+        """Return the resource serving the document, render is called only if not cached"""
+        resource = self.descriptions.get(path)
+        if resource is None:
+            resource = DescriptionResource(render())
+            self.descriptions[path] = resource
+        return resource
+
+    def getChild(self, path, request):
+        child = UPnP.getChild(self, path, request)	# Also fixes absolute URIs in the path
+        if isinstance(child, ServeResource):
+            return self.description('', self.device.dumps)
+        if isinstance(child, ServiceResource):
+            service = child.service
+            return TmServiceResource(service, self.description(service.serviceId, service.dumps))
+        return child
+
+
+class DescriptionResource(Resource):
+    """Static XML document with precomputed ETag and length"""
+    isLeaf = True
+
+    def __init__(self, data):
+        Resource.__init__(self)
+        self.data = data
+        self.etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        self.length = str(len(data))
+
+    def render_GET(self, request):
+        request.setHeader('ETag', self.etag)
+
+        match = request.getHeader('If-None-Match')
+        if match is not None:
+            tags = [tag.strip() for tag in match.split(',')]
+            if self.etag in tags or '*' in tags:
+                request.setResponseCode(304)
+                return ''
+
+        request.setHeader('Content-Type', 'text/xml; charset="utf-8"')
+        request.setHeader('Content-Length', self.length)
+        return self.data
+
+
+class TmServiceResource(ServiceResource):
+    def __init__(self, service, description):
+        ServiceResource.__init__(self, service)
+        self.description = description
+
+    def render(self, request):
+        return self.description.render(request)
+
+    def getChild(self, path, request):
+        if path == 'control':
+            return TmServiceControlResource(self.service)
+        return ServiceResource.getChild(self, path, request)
+
+
+class TmServiceControlResource(ServiceControlResource):
+    def render_POST(self, request):
+        data = request.content.getvalue()
+        (r, header, body, attrs) = parseSOAPRPC(data, header=1, body=1, attrs=1)
+
+        name = r._name
+        kwargs = r._asdict()
+
+        Logr.debug("(%s) %s", self.service.serviceType, name)
+
+        if name not in self.service.actions or name not in self.service.actionFunctions:
+            raise NotImplementedError()
+
+        action = self.service.actions[name]
+        func = self.service.actionFunctions[name]
+
+        for argument in action:
+            if argument.direction == 'in':
+                if argument.name in kwargs:
+                    value = kwargs[argument.name]
+                    del kwargs[argument.name]
+                    kwargs[argument.parameterName] = value
+                else:
+                    raise TypeError()
+
+        # Synchronous handlers and errors they raise are wrapped the same way
+        d = defer.maybeDeferred(func, **kwargs)
+        d.addCallbacks(self.actionDone, self.actionFailed,
+                       callbackArgs=(request, name), errbackArgs=(request, name))
+        return NOT_DONE_YET
+
+    def actionDone(self, result, request, name):
+        if request._disconnected:
+            return
+
+        request.setHeader('Content-Type', 'text/xml; charset="utf-8"')
+        # Same envelope as the synchronous pyUPnP control resource
+        request.write(buildSOAP(kw={'%sResponse' % name: result}))
+        request.finish()
+
+    def actionFailed(self, failure, request, name):
+        if failure.check(upnpError) and len(failure.value.args) >= 2:
+            code, description = failure.value.args[0], failure.value.args[1]
+        else:
+            Logr.warning("(%s) %s failed: %s", self.service.serviceType,
+                         name, failure.getErrorMessage())
+            code, description = 501, 'Action Failed'
+
+        if request._disconnected:
+            return
+
+        request.setResponseCode(500)
+        request.setHeader('Content-Type', 'text/xml; charset="utf-8"')
+        request.write(UPNP_ERROR.format(code, description))
+        request.finish()
@@ -2,33 +2,39 @@
 # Copyright (C) 2019 Lauri Peltonen
 
 import sys
+import os
 
 import argparse
 
+# Modules shared with the application server are in the parent directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The in-process application server needs the GLib main loop, so the GLib
+# based reactor must be installed before anything imports the reactor
+if '-l' in sys.argv or '--local' in sys.argv:
+    from twisted.internet import gireactor
+    gireactor.install()
+
 import logging
 from threading import Thread
-from twisted.internet import reactor
+from twisted.internet import reactor, threads
 from twisted.logger import globalLogPublisher
 from twisted.logger._levels import LogLevel
 
-from pyupnp.ssdp import SSDP
-from pyupnp.upnp import UPnP
 from pyupnp.logr import Logr
 
 from TmServerDevice import TmServerDevice
+from TmUPnP import TmUPnP
+from TmSSDP import TmSSDP
 
 class CommandThread(Thread):
-    def __init__(self, device, upnp, ssdp):
+    def __init__(self, sessions):
         """
 
-        :type device: Device
-        :type upnp: UPnP
-        :type ssdp: SSDP
+        :type sessions: list of Session
         """
         Thread.__init__(self)
-        self.device = device
-        self.upnp = upnp
-        self.ssdp = ssdp
+        self.sessions = sessions
 
         self.running = True
 
@@ -43,12 +49,9 @@ class CommandThread(Thread):
                 self.command_stop()
 
     def command_stop(self):
-        # Send 'byebye' NOTIFY
-        self.ssdp.clients.sendall_NOTIFY(None, 'ssdp:byebye', True)
-
-        # Stop everything
-        self.upnp.stop()
-        self.ssdp.stop()
+        # Send 'byebye' NOTIFY and stop everything
+        for session in self.sessions:
+            session.stop()
         reactor.stop()
         self.running = False
 
@@ -60,43 +63,140 @@ def analyze(event):
         reactor.stop()
 
 
-class UPnPServer:
-    def __init__(self, host):
-        Logr.configure(logging.DEBUG)
+def createApplicationServer(module, host, bus, session, vncPool, limits):
+    """Create the application server in this process"""
+    # Optionally also export the server on D-BUS for external control
+    if bus:
+        module.dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
-        self.host = host
+    return module.ApplicationServer(host, bus, session, vncPool, limits)
 
-        self.device = TmServerDevice(host)
 
-        self.upnp = UPnP(self.device)
-        self.ssdp = SSDP(self.device, [host], host)
+def importApplicationServer():
+    import ApplicationServer
+    return ApplicationServer
 
 
-    def run(self):
-        globalLogPublisher.addObserver(analyze)
+class SharedLimits:
+    """Resource limits shared by the application servers of all the sessions
+
+    The budgets are for the whole device, so there is one ResourceLimits,
+    created when the application server module has been imported.
+    """
+
+    def __init__(self, cpu=None, memory=None, cgroup='/sys/fs/cgroup/tmlink'):
+        self.cpu = cpu
+        self.memory = memory
+        self.cgroup = cgroup
+        self.limits = None
+
+    def get(self, module):
+        if self.limits is None:
+            self.limits = module.ResourceLimits(self.cpu, self.memory, self.cgroup)
+        return self.limits
+
+
+class Session:
+    """Device, listeners and applications served on one interface"""
+
+    def __init__(self, host, session, local=False, bus=False, vncPool=0, config=None, limits=None):
+        self.host = host
+        self.session = session
+        self.local = local
+        self.bus = bus
+        self.vncPool = vncPool
+        self.config = config
+        self.limits = limits or SharedLimits()
+
+        self.appServer = None	# Created after SSDP is up when local
 
+        self.device = TmServerDevice(host, None, session, local)
+
+        self.upnp = TmUPnP(self.device)
+        self.ssdp = TmSSDP(self.device, host)
+
+    def listen(self):
+        # Discovery is answered first, actions wait for the application server
         self.upnp.listen(interface=self.host)
         self.ssdp.listen()
 
         self.device.setBaseUrl(self.host)
 
-        r = CommandThread(self.device, self.upnp, self.ssdp)
+        if self.local:
+            # Importing lxml and dbus takes seconds on the Pi Zero, so that is done
+            # in a thread while the reactor already answers. The applications are
+            # registered (and auto launched) only after the reactor has installed
+            # its signal handlers, so that the GLib SIGCHLD handler used to
+            # follow the applications is not replaced.
+            reactor.callWhenRunning(self.startApplicationServer)
+
+    def startApplicationServer(self):
+        d = threads.deferToThread(importApplicationServer)
+        d.addCallback(self.createApplicationServer)
+        d.addErrback(self.device.tmApplicationServer.appServerFailed)
+
+    def createApplicationServer(self, module):
+        self.appServer = createApplicationServer(module, self.host, self.bus, self.session, self.vncPool,
+                                                 self.limits.get(module))
+        self.device.tmApplicationServer.setAppServer(self.appServer)
+        module.loadApplications(self.appServer, self.host, self.config)
+
+    def stop(self):
+        self.ssdp.sendByebye()
+        self.upnp.stop()
+        self.ssdp.stop()
+
+
+class UPnPServer:
+    def __init__(self, hosts, local=False, bus=False, vncPool=0, config=None, limits=None):
+        Logr.configure(logging.DEBUG)
+
+        # Each interface is served as an independent session, with its own
+        # device, application server and resources. Only the budgets are shared.
+        limits = limits or SharedLimits()
+        self.sessions = [Session(host, n, local, bus, vncPool, config, limits) for n, host in enumerate(hosts)]
+
+
+    def run(self):
+        globalLogPublisher.addObserver(analyze)
+
+        for session in self.sessions:
+            session.listen()
+
+        r = CommandThread(self.sessions)
         r.start()
 
         reactor.run()
 
+    def terminateAll(self):
+        for session in self.sessions:
+            if session.appServer is not None:
+                session.appServer.terminateAll(force=True)	# Also the auto launched VNC server
+
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-i', '--interface', help='interface (address) to listen on', default='192.168.10.1')
+    parser.add_argument('-i', '--interface', help='interface (address) to listen on, can be given multiple times', action='append')
+    parser.add_argument('-l', '--local', help='Run the application server in this process instead of over D-BUS', action='store_true')
+    parser.add_argument('-d', '--dbus', help='With --local, also export the application server on D-BUS', action='store_true')
+    parser.add_argument('-k', '--kill', help='With --local, kill applications when the server quits', action='store_true')
+    parser.add_argument('-V', '--vnc-pool', help='With --local, number of idle VNC servers to keep started in advance', default=0, type=int)
+    parser.add_argument('-c', '--config', help='With --local, application registry file (YAML or JSON)')
+    parser.add_argument('--cpu-budget', help='With --local, total CPU budget of the applications (percent of one CPU)', type=int)
+    parser.add_argument('--memory-budget', help='With --local, total memory budget of the applications (MB)', type=int)
+    parser.add_argument('--cgroup', help='With --local, cgroup (v2) directory for the applications, empty to not use cgroups', default='/sys/fs/cgroup/tmlink')
     args = parser.parse_args()
 
-    interface = args.interface
+    interfaces = args.interface or ['192.168.10.1']
 
     print('Launching UPnP server. Write stop or press CTRL+D (EOF) to quit')
-    upnpServer = UPnPServer(interface)
+    limits = SharedLimits(args.cpu_budget, args.memory_budget, args.cgroup)
+    upnpServer = UPnPServer(interfaces, args.local, args.dbus, args.vnc_pool, args.config, limits)
     upnpServer.run()
 
+    if args.kill:
+        upnpServer.terminateAll()
+
 
 if __name__ == '__main__':
     main()